@@ -0,0 +1,269 @@
+"""
+CPU benchmark of the GPT presets: forward, forward+backward and generate
+throughput (tokens/sec) and peak memory, for every combination of preset,
+batch size and block size.
+
+    # write a baseline
+    python -m gpt_mini.benchmark --out=benchmark.json
+    # after changing model.py, compare against it (exit status 1 on a
+    # slowdown or memory growth beyond the tolerance)
+    python -m gpt_mini.benchmark --out=new.json --compare=benchmark.json
+
+Each case runs in a fresh process so that its peak RSS is its own. With
+--slo_ms the summary names, for each batch and block size, the largest
+preset whose generate latency per token stays within that budget.
+
+The memory / time trade-off of activation checkpointing (see GPT's
+activation_checkpointing) on long contexts, training only:
+
+    python -m gpt_mini.benchmark --modes=train --block_sizes=512,1024,2048 --activation_checkpointing=0,1,2
+"""
+
+import json
+import time
+import platform
+import statistics
+import multiprocessing as mp
+
+import torch
+
+from gpt_mini.config import CONFIG
+from gpt_mini.profiling import peak_rss_mb
+from gpt_mini.utils import CfgNode as CN
+
+# smallest to largest, see GPT.__init__
+PRESETS = [
+    "gpt-nano", "gpt-micro", "gpt-mini", "gopher-44m",
+    "openai-gpt", "gpt2", "gpt2-medium", "gpt2-large", "gpt2-xl",
+]
+# higher is better for these, lower for everything ending in _mb
+THROUGHPUT = ("forward_tps", "train_tps", "generate_tps")
+
+
+def get_default_config():
+    C = CN()
+    # comma separated lists, every combination is a case
+    C.presets = "gpt-nano,gpt-micro,gpt-mini"
+    C.batch_sizes = "1,8"
+    C.block_sizes = "128,256"
+    C.vocab_size = CONFIG["tokenizer"]["vocab_size"]
+    C.attn_backend = "reference"
+    # any of forward, train, generate
+    C.modes = "forward,train,generate"
+    # comma separated list too, see GPT's activation_checkpointing
+    C.activation_checkpointing = "0"
+    # tokens produced per generate call, from a prompt of half the block
+    C.generate_tokens = 32
+    # untimed runs, then the median of this many timed ones
+    C.warmup = 2
+    C.repeats = 5
+    C.threads = None
+    C.seed = 1337
+    C.out = "benchmark.json"
+    # baseline to compare against, and the relative slack allowed
+    C.compare = None
+    C.tolerance = 0.10
+    # latency budget per generated token, in milliseconds
+    C.slo_ms = None
+    return C
+
+
+def _as_list(value, cast):
+    if isinstance(value, (list, tuple)):
+        return [cast(v) for v in value]
+    return [cast(v) for v in str(value).split(",") if v.strip()]
+
+
+def _timeit(fn, warmup, repeats) -> float:
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return statistics.median(times)
+
+
+def run_case(config, preset: str, batch_size: int, block_size: int, checkpointing: int = 0) -> dict:
+    """benchmark one model in this process"""
+    from gpt_mini.model import GPT
+
+    if config.threads is not None:
+        torch.set_num_threads(config.threads)
+    torch.manual_seed(config.seed)
+    base_rss = peak_rss_mb()
+
+    model_config = GPT.get_default_config()
+    model_config.model_type = preset
+    model_config.vocab_size = config.vocab_size
+    model_config.block_size = block_size
+    model_config.attn_backend = config.attn_backend
+    model_config.activation_checkpointing = checkpointing
+    model = GPT(model_config)
+    params = sum(p.numel() for p in model.parameters())
+
+    x = torch.randint(0, config.vocab_size, (batch_size, block_size))
+    prompt = x[:, : max(1, block_size // 2)]
+    tokens = batch_size * block_size
+
+    def forward():
+        with torch.no_grad():
+            model(x)
+
+    def train_step():
+        model.zero_grad(set_to_none=True)
+        _, loss = model(x, x)
+        loss.backward()
+
+    def generate():
+        model.generate(prompt, config.generate_tokens)
+
+    result = dict(
+        preset=preset,
+        batch_size=batch_size,
+        block_size=block_size,
+        activation_checkpointing=checkpointing,
+        params=params,
+        base_rss_mb=base_rss,
+    )
+    modes = _as_list(config.modes, str)
+    # training first: it sets the peak, which is then train_peak_rss_mb
+    if "train" in modes:
+        model.train()
+        train_s = _timeit(train_step, config.warmup, config.repeats)
+        result.update(
+            train_ms=1000 * train_s,
+            train_tps=tokens / train_s,
+            train_peak_rss_mb=peak_rss_mb(),
+        )
+        model.zero_grad(set_to_none=True)
+    model.eval()
+    if "forward" in modes:
+        forward_s = _timeit(forward, config.warmup, config.repeats)
+        result.update(forward_ms=1000 * forward_s, forward_tps=tokens / forward_s)
+    if "generate" in modes:
+        generate_s = _timeit(generate, config.warmup, config.repeats)
+        result.update(
+            generate_ms_per_token=1000 * generate_s / config.generate_tokens,
+            generate_tps=batch_size * config.generate_tokens / generate_s,
+        )
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+def _run_case_in_child(args):
+    return run_case(*args)
+
+
+def run(config) -> dict:
+    cases = [
+        (preset, batch_size, block_size, checkpointing)
+        for preset in _as_list(config.presets, str)
+        for batch_size in _as_list(config.batch_sizes, int)
+        for block_size in _as_list(config.block_sizes, int)
+        for checkpointing in _as_list(config.activation_checkpointing, int)
+    ]
+    results = []
+    # a new process per case (maxtasksperchild=1) keeps the peak RSS apart
+    with mp.get_context("spawn").Pool(1, maxtasksperchild=1) as pool:
+        for case in cases:
+            result = pool.apply(_run_case_in_child, ((config, *case),))
+            print(_describe(result))
+            results.append(result)
+    return dict(
+        meta=dict(
+            torch=torch.__version__,
+            python=platform.python_version(),
+            machine=platform.machine(),
+            processor=platform.processor(),
+            cpu_count=mp.cpu_count(),
+            threads=config.threads or torch.get_num_threads(),
+            time=time.time(),
+            config=config.to_dict(),
+        ),
+        results=results,
+    )
+
+
+def _key(r):
+    # baselines from before activation checkpointing have no such field
+    return (r["preset"], r["batch_size"], r["block_size"], r.get("activation_checkpointing", 0))
+
+
+def _describe(r) -> str:
+    parts = ["%-11s batch %3d block %5d ckpt %d:" % _key(r)]
+    if "forward_tps" in r:
+        parts.append("forward %9.0f tok/s" % r["forward_tps"])
+    if "train_tps" in r:
+        parts.append("train %9.0f tok/s (peak rss %.0f MB)" % (r["train_tps"], r["train_peak_rss_mb"] or 0))
+    if "generate_tps" in r:
+        parts.append("generate %8.1f tok/s (%.2f ms/token)" % (r["generate_tps"], r["generate_ms_per_token"]))
+    parts.append("peak rss %.0f MB" % (r["peak_rss_mb"] or 0))
+    return " ".join(parts)
+
+
+def compare(baseline: dict, current: dict, tolerance: float):
+    """
+    Return the regressions of current against baseline: throughput that
+    dropped, or peak memory that grew, by more than tolerance (relative).
+    Cases or metrics missing from either side are skipped.
+    """
+    old = {_key(r): r for r in baseline["results"]}
+    regressions = []
+    for new in current["results"]:
+        ref = old.get(_key(new))
+        if ref is None:
+            continue
+        for metric in THROUGHPUT:
+            if metric not in new or metric not in ref:
+                continue
+            ratio = new[metric] / ref[metric]
+            print("%-11s batch %3d block %5d ckpt %d %-13s %6.2fx" % (*_key(new), metric, ratio))
+            if ratio < 1 - tolerance:
+                regressions.append((_key(new), metric, ref[metric], new[metric]))
+        if ref.get("peak_rss_mb") and new.get("peak_rss_mb"):
+            if new["peak_rss_mb"] > ref["peak_rss_mb"] * (1 + tolerance):
+                regressions.append((_key(new), "peak_rss_mb", ref["peak_rss_mb"], new["peak_rss_mb"]))
+    return regressions
+
+
+def largest_within_slo(results, slo_ms: float) -> dict:
+    """(batch_size, block_size) -> largest preset generating within slo_ms per token"""
+    best = {}
+    for r in results:
+        if "generate_ms_per_token" not in r or r["generate_ms_per_token"] > slo_ms:
+            continue
+        k = (r["batch_size"], r["block_size"])
+        if k not in best or r["params"] > best[k]["params"]:
+            best[k] = r
+    return {k: r["preset"] for k, r in best.items()}
+
+
+if __name__ == "__main__":
+    import sys
+
+    config = get_default_config()
+    config.merge_from_args(sys.argv[1:])
+    for preset in _as_list(config.presets, str):
+        assert preset in PRESETS, f"unknown preset {preset}"
+
+    report = run(config)
+    with open(config.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print("wrote", config.out)
+
+    if config.slo_ms is not None:
+        best = largest_within_slo(report["results"], config.slo_ms)
+        for batch_size, block_size in sorted(best):
+            print(f"batch {batch_size} block {block_size}: largest within "
+                  f"{config.slo_ms}ms/token is {best[(batch_size, block_size)]}")
+
+    if config.compare is not None:
+        with open(config.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, report, config.tolerance)
+        for (preset, batch_size, block_size, ckpt), metric, before, after in regressions:
+            print(f"REGRESSION {preset} batch {batch_size} block {block_size} ckpt {ckpt} "
+                  f"{metric}: {before:.1f} -> {after:.1f}")
+        sys.exit(1 if regressions else 0)
@@ -6,6 +6,13 @@ from torch.utils.data import Dataset
 import gpt_mini.midi_encoder as me
 import numpy as np
 import pickle
+from gpt_mini.config import CONFIG
+from gpt_mini.token_cache import TokenCache
+
+
+def load_tokenizer(tokenizer_path: str):
+    with open(tokenizer_path, 'rb') as f:
+        return pickle.load(f)
 
 class CharDataset(Dataset):
     """
@@ -41,17 +48,21 @@ class MidiDataset(Dataset):
     """
     Break midi into tokens that we can encode and decode.
     """
-    def __init__(self, file_path, tokenizer_path: str, max_length=128, data_dir=""):
+    def __init__(self, file_path, tokenizer_path: str, max_length=128, data_dir="",
+                 cache_dir=CONFIG["tokenizer"]["cache"]):
         self.file_path = file_path
         self.data = self._load_data(file_path)
         # self.tokenizer = spm.SentencePieceProcessor()
         # self.tokenizer.load(tokenizer_path)
-        f = open(tokenizer_path, 'rb')
-        self.tokenizer = pickle.load(f)
-        f.close()
+        # every file is only tokenized once, later epochs read the cache
+        self.cache = TokenCache(tokenizer_path, cache_dir)
         self.max_length = max_length
         self.data_dir = data_dir
 
+    @property
+    def tokenizer(self):
+        return self.cache.tokenizer
+
     def _load_data(self, file_path):
         with open(file_path, "r", encoding="utf-8") as f:
             return f.readlines()
@@ -61,14 +72,156 @@ class MidiDataset(Dataset):
 
     def __getitem__(self, idx):
         file = self.data[idx].strip()
-        tokens = self.tokenizer.encode(f"{self.data_dir}{file}")
-        tokens = tokens[0].ids
+        tokens = self.cache.ids(f"{self.data_dir}{file}")
         # Truncate if longer
-        tokens = tokens[: self.max_length]
+        tokens = tokens[: self.max_length].tolist()
+        length = len(tokens)
         if len(tokens) < self.max_length:
             # Pad if shorter
             tokens = tokens + [0] * (self.max_length - len(tokens))
 
         x = torch.tensor(tokens[:-1], dtype=torch.long)
         y = torch.tensor(tokens[1:], dtype=torch.long)
+        # no loss on the padding (see GPT.forward)
+        y[max(length - 1, 0) :] = -1
+        return x, y
+
+
+def pretokenize(file_path: str, tokenizer_path: str, out_prefix: str, data_dir="",
+                cache_dir=CONFIG["tokenizer"]["cache"]):
+    """
+    One-time pass over a file list (data_train.txt, data_validation.txt) that
+    runs every midi file through the tokenizer and writes the result as:
+
+    - {out_prefix}.tokens      all token ids back to back (raw, no header)
+    - {out_prefix}.index.npz   the song offsets into that array and its dtype
+
+    Song i is tokens[offsets[i]:offsets[i+1]]. MemmapMidiDataset reads this.
+    Files already tokenized (see TokenCache) are not parsed again.
+    """
+    cache = TokenCache(tokenizer_path, cache_dir)
+    dtype = np.dtype(np.uint16 if len(cache.tokenizer) <= 65536 else np.uint32)
+
+    with open(file_path, "r", encoding="utf-8") as f:
+        files = [line.strip() for line in f if line.strip()]
+
+    offsets = np.zeros(len(files) + 1, dtype=np.int64)
+    with open(f"{out_prefix}.tokens", "wb") as out:
+        for i, file in enumerate(files):
+            ids = cache.ids(f"{data_dir}{file}").astype(dtype)
+            ids.tofile(out)
+            offsets[i + 1] = offsets[i] + len(ids)
+
+    np.savez(f"{out_prefix}.index.npz", offsets=offsets, dtype=np.array(dtype.str))
+    print(f"{file_path}: {len(files)} songs, {offsets[-1]} tokens -> {out_prefix}.tokens")
+
+
+class MemmapMidiDataset(Dataset):
+    """
+    Drop-in replacement for MidiDataset that reads the output of pretokenize
+    instead of parsing midi files. The token file is memory mapped, so there is
+    nothing to parse per sample and all DataLoader workers share the same pages
+    through the OS page cache. The map is opened lazily (and never pickled) so
+    worker startup stays cheap.
+    """
+    def __init__(self, prefix: str, max_length=128):
+        index = np.load(f"{prefix}.index.npz")
+        self.offsets = index["offsets"]
+        self.dtype = np.dtype(str(index["dtype"]))
+        self.tokens_path = f"{prefix}.tokens"
+        self.max_length = max_length
+        self._tokens = None
+
+    @property
+    def tokens(self) -> np.memmap:
+        if self._tokens is None:
+            self._tokens = np.memmap(self.tokens_path, dtype=self.dtype, mode="r")
+        return self._tokens
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_tokens"] = None
+        return state
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lengths(self) -> np.ndarray:
+        """tokens per sample after truncation, for samplers.BucketBatchSampler"""
+        return np.minimum(np.diff(self.offsets), self.max_length)
+
+    def __getitem__(self, idx):
+        start = self.offsets[idx]
+        # Truncate if longer
+        end = min(self.offsets[idx + 1], start + self.max_length)
+        # Pad if shorter
+        tokens = np.zeros(self.max_length, dtype=np.int64)
+        tokens[: end - start] = self.tokens[start:end]
+
+        x = torch.from_numpy(tokens[:-1])
+        y = torch.from_numpy(tokens[1:].copy())
+        # no loss on the padding (see GPT.forward)
+        y[max(end - start - 1, 0) :] = -1
         return x, y
+
+
+class PackedMidiDataset(MemmapMidiDataset):
+    """
+    The pre-tokenized songs (see pretokenize) laid end to end, each one
+    followed by a separator token, and cut into blocks of max_length tokens
+    with no padding at all. A song longer than a block simply continues in
+    the next one, a short one shares its block with the next songs.
+
+    The target after a separator (the first token of the next song, which
+    the previous song says nothing about) is set to -1 so it carries no
+    loss; predicting the separator itself, i.e. where a song ends, is
+    trained. Attention is not blocked between the songs in a block.
+
+    With seed the songs are put in a random (but fixed) order first.
+    """
+    def __init__(self, prefix: str, max_length=128, separator=0, seed=None):
+        super().__init__(prefix, max_length)
+        self.separator = separator
+        self.song_lengths = np.diff(self.offsets)
+        self.order = np.arange(len(self.song_lengths))
+        if seed is not None:
+            self.order = np.random.default_rng(seed).permutation(len(self.song_lengths))
+        # where each song (in packing order) starts in the packed stream
+        packed = self.song_lengths[self.order] + 1
+        self.starts = np.concatenate([[0], np.cumsum(packed)[:-1]])
+        self.stream_length = int(packed.sum())
+
+    def __len__(self):
+        # blocks of max_length tokens: x and y are max_length - 1 long and the
+        # last token of a block is the first of the next
+        return max(0, (self.stream_length - 1) // (self.max_length - 1))
+
+    def lengths(self) -> np.ndarray:
+        # every block is full
+        return np.full(len(self), self.max_length)
+
+    def __getitem__(self, idx):
+        first = idx * (self.max_length - 1)
+        positions = np.arange(first, first + self.max_length)
+        song = np.searchsorted(self.starts, positions, side="right") - 1
+        local = positions - self.starts[song]
+        source = self.order[song]
+        is_separator = local == self.song_lengths[source]
+        # separator positions read a valid (ignored) index instead
+        index = self.offsets[source] + np.minimum(local, self.song_lengths[source] - 1)
+        tokens = self.tokens[np.maximum(index, 0)].astype(np.int64)
+        tokens[is_separator] = self.separator
+
+        x = torch.from_numpy(tokens[:-1])
+        y = torch.from_numpy(tokens[1:].copy())
+        y[is_separator[:-1]] = -1
+        return x, y
+
+
+if __name__ == "__main__":
+    # python -m gpt_mini.bpe
+    for split in ("train", "validation"):
+        pretokenize(
+            CONFIG["preprocess"][f"data_{split}"],
+            CONFIG["tokenizer"]["model"],
+            CONFIG["preprocess"][f"tokens_{split}"])
@@ -0,0 +1,120 @@
+"""
+Training checkpoints: periodic, atomic, written from a background thread.
+
+A checkpoint is a plain dict saved with torch.save, the model weights under
+"model" load straight into GPT.load_state_dict.
+"""
+
+import os
+import glob
+import random
+import threading
+
+import numpy as np
+import torch
+
+
+def to_cpu(obj, memo=None):
+    """
+    copy every tensor in a (nested) state dict to the cpu. Tensors that are
+    the same memory (tied weights) stay one tensor, as torch.save keeps them.
+    """
+    memo = {} if memo is None else memo
+    if isinstance(obj, torch.Tensor):
+        key = (obj.device, obj.data_ptr(), obj.dtype, obj.size(), obj.stride())
+        if key not in memo:
+            memo[key] = obj.detach().to("cpu", copy=True)
+        return memo[key]
+    if isinstance(obj, dict):
+        return {k: to_cpu(v, memo) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v, memo) for v in obj)
+    return obj
+
+
+def get_rng_state() -> dict:
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state: dict):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    # the generators only take cpu ByteTensors, whatever map_location did
+    torch.set_rng_state(state["torch"].cpu())
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state["cuda"]])
+
+
+def atomic_save(obj, path: str):
+    tmp = path + ".tmp"
+    torch.save(obj, tmp)
+    os.replace(tmp, path)
+
+
+class CheckpointManager:
+    """
+    Writes ckpt_XXXXXXXX.pt files into directory and keeps the newest
+    keep_last of them, plus best.pt. Saves run one at a time in a background
+    thread; the state handed to save() must already be a private copy (see
+    to_cpu) since training carries on while it is written.
+    """
+
+    def __init__(self, directory: str, keep_last: int = 3):
+        self.directory = directory
+        self.keep_last = keep_last
+        self._thread = None
+        self._error = None
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, iter_num: int) -> str:
+        return os.path.join(self.directory, f"ckpt_{iter_num:08d}.pt")
+
+    @property
+    def best_path(self) -> str:
+        return os.path.join(self.directory, "best.pt")
+
+    def checkpoints(self):
+        return sorted(glob.glob(os.path.join(self.directory, "ckpt_*.pt")))
+
+    def latest(self) -> str:
+        checkpoints = self.checkpoints()
+        return checkpoints[-1] if checkpoints else None
+
+    def _write(self, state, path, prune):
+        try:
+            atomic_save(state, path)
+            if prune:
+                for old in self.checkpoints()[: -self.keep_last]:
+                    os.remove(old)
+        except Exception as e:
+            self._error = e
+
+    def save(self, state: dict, iter_num: int):
+        self._submit(state, self.path(iter_num), prune=True)
+
+    def save_best(self, state: dict):
+        self._submit(state, self.best_path, prune=False)
+
+    def _submit(self, state, path, prune):
+        self.wait()
+        self._thread = threading.Thread(target=self._write, args=(state, path, prune))
+        self._thread.start()
+
+    def wait(self):
+        """block until the save in flight (if any) is on disk"""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def load(self, path: str, map_location="cpu") -> dict:
+        return torch.load(path, map_location=map_location, weights_only=False)
@@ -17,13 +17,18 @@ CONFIG = {
         "new_dataset_index": "training_data.txt",
         "data_train": "data_train.txt",
         "data_validation": "data_validation.txt",
+        # pre-tokenized versions of the above (see bpe.pretokenize)
+        "tokens_train": "data_train",
+        "tokens_validation": "data_validation",
         # Stop after processing this many items from
         # the original dataset
         "max_dataset_items": 8000,
     },
     "tokenizer": {
         "vocab_size": 50257,
-        "model": "./checkpoints/midi_tokenizer_bpe.pkl"
+        "model": "./checkpoints/midi_tokenizer_bpe.pkl",
+        # tokenized midi files, see token_cache.py
+        "cache": "./cache/tokens",
     },
     "model": {
         # See model.py for suggestions
@@ -31,7 +36,10 @@ CONFIG = {
         "n_head": 4,
         "n_embed": 128,
         ##
+        # should match the trained tokenizer, see vocab.tokenizer_vocab_size
         "vocab_size": 50257,
+        # share the embedding matrix with the output layer
+        "tie_weights": False,
         "block_size": 256,
         # dropout hyperparameters
         "embd_pdrop": 0.1,
@@ -0,0 +1,134 @@
+"""
+Picking the next token from the logits of the last position, for
+GPT.generate, GPT.generate_batch and speculative decoding.
+"""
+
+import torch
+import torch.nn.functional as F
+
+
+class TokenSampler:
+    """
+    Greedy decoding (do_sample=False) is a plain argmax. Otherwise the
+    logits are scaled by temperature, cut down to the top_k candidates
+    and/or the nucleus of the top_p most likely ones, and the softmax and
+    the draw only run over what is left instead of the whole vocabulary.
+
+    repetition_penalty > 1 makes tokens already in the context less likely
+    (the logit is divided by it when positive, multiplied when negative).
+
+    With a seed the draws come from the sampler's own generator, so the
+    same request gives the same tokens no matter what else runs in the
+    process (or in the same batch, see GPT.generate_batch). Without one
+    they come from the global torch RNG.
+    """
+
+    # how many of the most likely tokens to search for the top_p nucleus
+    # first, widened 8x at a time before sorting the whole vocabulary
+    nucleus_search = 256
+
+    def __init__(
+        self,
+        temperature: float = 1.0,
+        top_k: int = None,
+        top_p: float = None,
+        repetition_penalty: float = 1.0,
+        do_sample: bool = True,
+        seed: int = None,
+    ):
+        assert temperature > 0, "temperature must be positive, use do_sample=False for greedy"
+        assert top_p is None or 0 < top_p <= 1
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.repetition_penalty = repetition_penalty
+        self.do_sample = do_sample
+        self.seed = seed
+        self._generator = None
+
+    def generator(self, device):
+        """the torch.Generator all of this sampler's draws use, None without a seed"""
+        if self.seed is None:
+            return None
+        if self._generator is None:
+            self._generator = torch.Generator(device=device)
+            self._generator.manual_seed(self.seed)
+        return self._generator
+
+    def penalize(self, logits, context, context_mask=None):
+        """apply the repetition penalty to the tokens in context (B, T)"""
+        counts = torch.zeros_like(logits, dtype=torch.int32)
+        ones = torch.ones_like(context, dtype=torch.int32) if context_mask is None else context_mask.int()
+        seen = counts.scatter_add_(1, context, ones) > 0
+        penalized = torch.where(
+            logits > 0, logits / self.repetition_penalty, logits * self.repetition_penalty)
+        return torch.where(seen, penalized, logits)
+
+    def _most_likely(self, logits):
+        """
+        logits, token ids and probabilities of the most likely tokens, most
+        likely first, at least covering top_p of the probability mass. The
+        nucleus of a trained model is nearly always among the first few
+        hundred tokens so those are tried first, and the whole vocabulary is
+        sorted only if needed.
+        """
+        probs = F.softmax(logits, dim=-1)
+        k = self.nucleus_search
+        while k < logits.size(-1):
+            top, ids = torch.topk(probs, k, dim=-1)
+            if bool((top.sum(dim=-1) >= self.top_p).all()):
+                return torch.gather(logits, -1, ids), ids, top
+            k *= 8
+        probs, ids = torch.sort(probs, dim=-1, descending=True)
+        return torch.gather(logits, -1, ids), ids, probs
+
+    def probs(self, logits, context=None, context_mask=None):
+        """
+        The (B, V) distribution __call__ draws from, over the whole vocabulary
+        (one-hot on the argmax when greedy). Slower than __call__, it is for
+        comparing two models' choices (see speculative.py).
+        """
+        if self.repetition_penalty != 1.0 and context is not None:
+            logits = self.penalize(logits, context, context_mask)
+        if not self.do_sample:
+            return F.one_hot(torch.argmax(logits, dim=-1), logits.size(-1)).to(logits.dtype)
+
+        logits = logits / self.temperature
+        if self.top_k is not None and self.top_k < logits.size(-1):
+            kth = torch.topk(logits, self.top_k, dim=-1).values[:, -1:]
+            logits = logits.masked_fill(logits < kth, -float("Inf"))
+        if self.top_p is not None and self.top_p < 1:
+            probs, ids = torch.sort(F.softmax(logits, dim=-1), dim=-1, descending=True)
+            outside = probs.cumsum(dim=-1) - probs >= self.top_p
+            logits = logits.masked_fill(torch.zeros_like(outside).scatter(-1, ids, outside), -float("Inf"))
+        return F.softmax(logits, dim=-1)
+
+    def __call__(self, logits, context=None, context_mask=None):
+        """
+        logits is (B, V) for the next position, context the (B, T) tokens so
+        far (only needed for the repetition penalty) with context_mask marking
+        the real ones among them. Returns the (B, 1) next token ids.
+        """
+        if self.repetition_penalty != 1.0 and context is not None:
+            logits = self.penalize(logits, context, context_mask)
+        if not self.do_sample:
+            return torch.argmax(logits, dim=-1, keepdim=True)
+
+        logits = logits / self.temperature
+        candidates = None
+        if self.top_k is not None and self.top_k < logits.size(-1):
+            # sorted, most likely first
+            logits, candidates = torch.topk(logits, self.top_k, dim=-1)
+        if self.top_p is not None and self.top_p < 1:
+            if candidates is None:
+                logits, candidates, probs = self._most_likely(logits)
+            else:
+                probs = F.softmax(logits, dim=-1)
+            # drop a candidate once the ones before it already cover top_p,
+            # the most likely one always stays
+            outside = probs.cumsum(dim=-1) - probs >= self.top_p
+            logits = logits.masked_fill(outside, -float("Inf"))
+
+        probs = F.softmax(logits, dim=-1)
+        choice = torch.multinomial(probs, num_samples=1, generator=self.generator(probs.device))
+        return choice if candidates is None else torch.gather(candidates, -1, choice)
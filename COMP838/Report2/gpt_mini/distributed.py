@@ -0,0 +1,120 @@
+"""
+Multi-process data parallel training on CPU with the gloo backend.
+
+The Trainer switches to data parallel mode by itself when a process group is
+initialised before it is created. Two ways to get there:
+
+- on one machine, launch(fn, world_size, *args) starts world_size processes
+  and calls fn(*args) in each of them once the group is up.
+- across machines (or on one) use torchrun, which sets RANK, WORLD_SIZE,
+  MASTER_ADDR and MASTER_PORT, and call init_from_env() in the script:
+
+    torchrun --nnodes=2 --nproc_per_node=8 --rdzv_endpoint=host:29500 train.py
+
+Smoke test with several ranks on this machine:
+
+    python -m gpt_mini.distributed --world_size=4 --max_iters=50
+"""
+
+import os
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from gpt_mini.utils import CfgNode as CN
+
+
+def init_from_env(backend: str = "gloo"):
+    """join the process group described by the torchrun environment variables"""
+    dist.init_process_group(backend)
+
+
+def _worker(rank, fn, world_size, args, backend, master_addr, master_port, threads):
+    os.environ["MASTER_ADDR"] = master_addr
+    os.environ["MASTER_PORT"] = str(master_port)
+    os.environ["RANK"] = str(rank)
+    os.environ["WORLD_SIZE"] = str(world_size)
+    if threads is not None:
+        # the cores are shared between the ranks
+        torch.set_num_threads(threads)
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+    try:
+        fn(*args)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch(fn, world_size: int, *args, backend="gloo", master_addr="127.0.0.1",
+           master_port=29500, threads_per_rank=None):
+    """
+    Run fn(*args) in world_size processes on this machine, each with an
+    initialised process group. fn has to be picklable (a module level
+    function).
+    """
+    if threads_per_rank is None:
+        threads_per_rank = max(1, (os.cpu_count() or 1) // world_size)
+    mp.spawn(
+        _worker,
+        args=(fn, world_size, args, backend, master_addr, master_port, threads_per_rank),
+        nprocs=world_size,
+        join=True,
+    )
+
+
+def get_default_config():
+    C = CN()
+    C.world_size = 2
+    C.max_iters = 20
+    C.batch_size = 8
+    C.block_size = 64
+    C.vocab_size = 512
+    C.master_port = 29500
+    return C
+
+
+def _smoke_train(config):
+    # local imports, this runs in the spawned processes
+    from torch.utils.data import TensorDataset
+    from gpt_mini.model import GPT
+    from gpt_mini.trainer import Trainer
+
+    torch.manual_seed(1234 + dist.get_rank())
+    data = torch.randint(0, config.vocab_size, (1024, config.block_size + 1))
+    dataset = TensorDataset(data[:, :-1], data[:, 1:])
+
+    model_config = GPT.get_default_config()
+    model_config.model_type = "gpt-nano"
+    model_config.vocab_size = config.vocab_size
+    model_config.block_size = config.block_size
+    model = GPT(model_config)
+
+    train_config = Trainer.get_default_config()
+    train_config.device = "cpu"
+    train_config.num_workers = 0
+    train_config.max_iters = config.max_iters
+    train_config.batch_size = config.batch_size
+    train_config.validation_interval = config.max_iters
+    train_config.max_sample_size = len(dataset)
+    train_config.metrics_interval = 10
+    trainer = Trainer(train_config, model, dataset, dataset)
+    trainer.set_callback(
+        "on_metrics",
+        lambda t: print(f"iter {t.iter_num}: train loss {t.train_metrics['loss']:.5f}"))
+    trainer.run()
+
+    # all ranks must have ended up with the same weights
+    flat = torch.cat([p.detach().flatten() for p in model.parameters()])
+    lo, hi = flat.clone(), flat.clone()
+    dist.all_reduce(lo, op=dist.ReduceOp.MIN)
+    dist.all_reduce(hi, op=dist.ReduceOp.MAX)
+    if dist.get_rank() == 0:
+        print("weights in sync across ranks:", torch.equal(lo, hi))
+
+
+if __name__ == "__main__":
+    import sys
+
+    config = get_default_config()
+    config.merge_from_args(sys.argv[1:])
+    launch(_smoke_train, config.world_size, config, master_port=config.master_port)
@@ -0,0 +1,186 @@
+"""
+Rhythmic features (see midi_encoder.rhythmic_features) for a whole corpus.
+
+Every file is parsed once, in a process pool, and its features are kept in
+a columnar table (an .npz of one array per feature) keyed by the sha1 of the
+file's contents. A rerun hashes the files again and only parses the ones
+whose hash is not in the table yet; files whose path, size and mtime match
+the last run are not even read.
+
+    python -m gpt_mini.features --index=training_data.txt --table=features.npz
+
+or from a notebook
+
+    table = extract_features(df["data"])
+    df["complexity"], df["bpm"] = table["total"], table["bpm"]
+"""
+
+import io
+import os
+import hashlib
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pretty_midi
+
+import gpt_mini.midi_encoder as me
+from gpt_mini.config import CONFIG
+from gpt_mini.utils import CfgNode as CN
+
+logger = logging.getLogger(__name__)
+
+FEATURES = (
+    "entropy_ioi", "entropy_duration", "mean_ioi", "std_ioi",
+    "mean_duration", "std_duration", "bpm", "total",
+)
+# bump when the features change meaning, old tables are then ignored
+VERSION = 1
+
+
+def file_hash(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+
+def _features_of(data: bytes, bins: int):
+    pm = pretty_midi.PrettyMIDI(io.BytesIO(data), resolution=me.COMMON_RESOLUTION)
+    features = me.rhythmic_features(me.drum_tracks(pm), bins)
+    return [float(features[name]) for name in FEATURES]
+
+
+def _extract(jobs, bins):
+    """worker: features for a list of (path, hash), NaN where a file fails"""
+    rows = []
+    for path, digest in jobs:
+        try:
+            with open(path, "rb") as f:
+                rows.append((digest, _features_of(f.read(), bins), None))
+        except Exception as e:
+            rows.append((digest, [np.nan] * len(FEATURES), f"{type(e).__name__}: {e}"))
+    return rows
+
+
+class FeatureTable:
+    """
+    The on-disk table: rows of features keyed by content hash, plus the
+    (path, size, mtime) -> hash index that lets unchanged files skip hashing.
+    Files that could not be parsed have a row of NaNs so they are not
+    retried until they change.
+    """
+
+    def __init__(self, path: str, bins: int = 10):
+        self.path = path
+        self.bins = bins
+        self.rows = {}
+        self.stats = {}
+        self.dirty = False
+        if os.path.exists(path):
+            with np.load(path, allow_pickle=False) as table:
+                if int(table["version"]) == VERSION and int(table["bins"]) == bins:
+                    values = np.stack([table[name] for name in FEATURES], axis=1)
+                    self.rows = dict(zip(table["hash"].tolist(), values))
+                    self.stats = {
+                        p: (s, m, h) for p, s, m, h in zip(
+                            table["stat_path"].tolist(), table["stat_size"].tolist(),
+                            table["stat_mtime"].tolist(), table["stat_hash"].tolist())
+                    }
+                else:
+                    logger.warning("%s was made with other settings, starting over", path)
+
+    def hash_of(self, path: str) -> str:
+        st = os.stat(path)
+        cached = self.stats.get(path)
+        if cached is not None and cached[:2] == (st.st_size, st.st_mtime_ns):
+            return cached[2]
+        with open(path, "rb") as f:
+            digest = file_hash(f.read())
+        self.stats[path] = (st.st_size, st.st_mtime_ns, digest)
+        self.dirty = True
+        return digest
+
+    def save(self):
+        hashes = list(self.rows)
+        values = np.array([self.rows[h] for h in hashes], dtype=np.float64).reshape(-1, len(FEATURES))
+        stat_paths = list(self.stats)
+        columns = {name: values[:, i] for i, name in enumerate(FEATURES)}
+        tmp = self.path + ".tmp.npz"
+        np.savez(
+            tmp,
+            version=np.array(VERSION),
+            bins=np.array(self.bins),
+            hash=np.array(hashes, dtype="U40"),
+            stat_path=np.array(stat_paths, dtype=str),
+            stat_size=np.array([self.stats[p][0] for p in stat_paths], dtype=np.int64),
+            stat_mtime=np.array([self.stats[p][1] for p in stat_paths], dtype=np.int64),
+            stat_hash=np.array([self.stats[p][2] for p in stat_paths], dtype="U40"),
+            **columns,
+        )
+        os.replace(tmp, self.path)
+        self.dirty = False
+
+
+def extract_features(paths, table_path="features.npz", workers=None, bins=10, chunk_size=32) -> dict:
+    """
+    Features for every file in paths, computing only those not in the table
+    at table_path (which is then updated). Returns a dict of columns aligned
+    with paths: "path", "hash" and one float array per name in FEATURES
+    (NaN for files that could not be parsed).
+    """
+    paths = [str(p).strip() for p in paths]
+    table = FeatureTable(table_path, bins)
+    hashes = []
+    for path in paths:
+        try:
+            hashes.append(table.hash_of(path))
+        except OSError as e:
+            logger.warning("could not read %s: %s", path, e)
+            hashes.append("")
+
+    todo, seen = [], set()
+    for path, digest in zip(paths, hashes):
+        if digest and digest not in table.rows and digest not in seen:
+            seen.add(digest)
+            todo.append((path, digest))
+    logger.info("%d files, %d to parse", len(paths), len(todo))
+
+    if todo:
+        chunks = [todo[i : i + chunk_size] for i in range(0, len(todo), chunk_size)]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for rows in pool.map(_extract, chunks, [bins] * len(chunks)):
+                for digest, values, error in rows:
+                    if error is not None:
+                        logger.warning("could not parse %s: %s", digest, error)
+                    table.rows[digest] = np.array(values)
+        table.dirty = True
+    if table.dirty:
+        table.save()
+
+    missing = np.full(len(FEATURES), np.nan)
+    values = np.stack([table.rows.get(h, missing) for h in hashes]) if paths else np.empty((0, len(FEATURES)))
+    result = {"path": np.array(paths), "hash": np.array(hashes)}
+    result.update({name: values[:, i] for i, name in enumerate(FEATURES)})
+    return result
+
+
+def get_default_config():
+    C = CN()
+    # one midi file per line
+    C.index = CONFIG["preprocess"]["new_dataset_index"]
+    C.table = "features.npz"
+    C.workers = os.cpu_count()
+    C.bins = 10
+    return C
+
+
+if __name__ == "__main__":
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+    config = get_default_config()
+    config.merge_from_args(sys.argv[1:])
+    with open(config.index, "r", encoding="utf-8") as f:
+        files = [line.strip() for line in f if line.strip()]
+    table = extract_features(files, config.table, config.workers, config.bins)
+    ok = ~np.isnan(table["total"])
+    print(f"{ok.sum()} of {len(files)} files, mean complexity {np.nanmean(table['total']):.4f}, "
+          f"median bpm {np.nanmedian(table['bpm']):.0f}")
@@ -0,0 +1,165 @@
+"""
+Load generator for server.py: sends /generate requests from a number of
+concurrent clients (closed loop), or at a fixed rate (open loop, --rate),
+and reports the latency seen by the clients next to the server's own
+/metrics.
+
+    python -m gpt_mini.server --checkpoint=checkpoints/best.pt &
+    python -m gpt_mini.loadgen --requests=200 --concurrency=16
+    python -m gpt_mini.loadgen --prompt=./input/1.mid --rate=20
+
+Without --prompt every request is a random prompt of prompt_length token
+ids, sent as JSON (no tokenizer needed on either side). The ids are drawn
+below the served model's vocab_size, as reported by /health.
+"""
+
+import json
+import time
+import random
+import asyncio
+
+import numpy as np
+
+from gpt_mini.server import read_message
+from gpt_mini.utils import CfgNode as CN
+
+
+def get_default_config():
+    C = CN()
+    C.host = "127.0.0.1"
+    C.port = 8000
+    C.requests = 100
+    # closed loop: this many clients, each sending its next request when
+    # the previous one is answered
+    C.concurrency = 8
+    # open loop: requests per second (Poisson arrivals), overrides concurrency
+    C.rate = None
+    # a midi file, or None for random prompts of prompt_length ids
+    C.prompt = None
+    C.prompt_length = 32
+    # None: the served model's, from /health
+    C.vocab_size = None
+    C.steps = 32
+    C.seed = 1337
+    return C
+
+
+class Client:
+    """one keep-alive connection"""
+
+    def __init__(self, host, port):
+        self.host, self.port = host, port
+        self.reader = self.writer = None
+
+    async def request(self, method, path, body=b"", content_type="application/json"):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.writer.write(
+            f"{method} {path} HTTP/1.1\r\nHost: {self.host}\r\n"
+            f"Content-Type: {content_type}\r\nContent-Length: {len(body)}\r\n\r\n".encode("latin-1")
+            + body
+        )
+        await self.writer.drain()
+        message = await read_message(self.reader)
+        if message is None:
+            raise ConnectionError("connection closed")
+        start, headers, payload = message
+        if headers.get("connection", "").lower() == "close":
+            self.close()
+        return int(start.split(" ")[1]), payload
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+
+async def run(config) -> dict:
+    rng = random.Random(config.seed)
+    vocab_size = config.vocab_size
+    if config.prompt is not None:
+        with open(config.prompt, "rb") as f:
+            midi = f.read()
+    elif vocab_size is None:
+        client = Client(config.host, config.port)
+        _, health = await client.request("GET", "/health")
+        client.close()
+        vocab_size = json.loads(health)["vocab_size"]
+
+    def make_request(i):
+        path = f"/generate?steps={config.steps}&seed={config.seed + i}"
+        if config.prompt is not None:
+            return path, midi, "audio/midi"
+        tokens = [rng.randrange(1, vocab_size) for _ in range(config.prompt_length)]
+        return path, json.dumps({"tokens": tokens}).encode(), "application/json"
+
+    latencies, errors = [], 0
+
+    async def send(client, i):
+        nonlocal errors
+        path, body, content_type = make_request(i)
+        t0 = time.perf_counter()
+        try:
+            status, _ = await client.request("POST", path, body, content_type)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            client.close()
+            status = None
+        if status == 200:
+            latencies.append(1000 * (time.perf_counter() - t0))
+        else:
+            errors += 1
+
+    start = time.perf_counter()
+    if config.rate is None:
+        counter = iter(range(config.requests))
+
+        async def worker():
+            client = Client(config.host, config.port)
+            for i in counter:
+                await send(client, i)
+            client.close()
+
+        await asyncio.gather(*(worker() for _ in range(config.concurrency)))
+    else:
+        tasks = []
+        for i in range(config.requests):
+            # a new connection per request so slow answers do not hold back arrivals
+            client = Client(config.host, config.port)
+            tasks.append(asyncio.create_task(send(client, i)))
+            tasks[-1].add_done_callback(lambda _, c=client: c.close())
+            await asyncio.sleep(rng.expovariate(config.rate))
+        await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+
+    client = Client(config.host, config.port)
+    _, server_metrics = await client.request("GET", "/metrics")
+    client.close()
+
+    report = dict(
+        requests=config.requests,
+        errors=errors,
+        elapsed_s=elapsed,
+        requests_per_s=len(latencies) / elapsed,
+        tokens_per_s=len(latencies) * config.steps / elapsed,
+        server=json.loads(server_metrics),
+    )
+    if latencies:
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        report["latency_ms"] = dict(p50=p50, p95=p95, p99=p99, mean=float(np.mean(latencies)))
+    return report
+
+
+if __name__ == "__main__":
+    import sys
+
+    config = get_default_config()
+    config.merge_from_args(sys.argv[1:])
+    report = asyncio.run(run(config))
+    latency = report.get("latency_ms", {})
+    server = report["server"]
+    print(f"{report['requests'] - report['errors']}/{report['requests']} ok in {report['elapsed_s']:.2f}s: "
+          f"{report['requests_per_s']:.1f} req/s, {report['tokens_per_s']:.0f} tokens/s")
+    if latency:
+        print(f"client latency ms: p50 {latency['p50']:.1f} p95 {latency['p95']:.1f} p99 {latency['p99']:.1f}")
+    print(f"server: mean batch {server['mean_batch_size']:.2f} over {server['batches']} batches, "
+          f"queue p50 {server['queue_ms'].get('p50', 0):.1f} ms, batch p50 {server['batch_ms'].get('p50', 0):.1f} ms")
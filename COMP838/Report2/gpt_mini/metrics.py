@@ -0,0 +1,79 @@
+"""
+Running loss / accuracy / perplexity that stay on the device between flushes,
+so the training loop never has to wait on a .item() per step.
+"""
+
+import json
+import math
+import time
+
+import torch
+import torch.distributed as dist
+
+
+class Metrics:
+    """
+    Accumulates token weighted loss and token level accuracy as device
+    tensors. flush() reads them back (the only host sync), resets the
+    window and, if log_path is set, appends one JSON line to it so the file
+    can be tailed while training runs.
+
+    Targets equal to ignore_index (padding, see GPT.forward) are not counted.
+    """
+
+    def __init__(self, log_path: str = None, ignore_index: int = -1):
+        self.log_path = log_path
+        self.ignore_index = ignore_index
+        self.reset()
+
+    def reset(self):
+        self.loss_sum = None
+        self.correct = None
+        self.tokens = None
+        self.steps = 0
+
+    def update(self, loss: torch.Tensor, logits: torch.Tensor, targets: torch.Tensor):
+        """loss is the mean over the valid targets, as returned by GPT.forward"""
+        with torch.no_grad():
+            valid = targets != self.ignore_index
+            tokens = valid.sum()
+            correct = ((torch.argmax(logits, dim=-1) == targets) & valid).sum()
+            loss_sum = loss.detach().float() * tokens
+            if self.steps == 0:
+                self.loss_sum, self.correct, self.tokens = loss_sum, correct, tokens
+            else:
+                self.loss_sum += loss_sum
+                self.correct += correct
+                self.tokens += tokens
+        self.steps += 1
+
+    def flush(self, reduce: bool = False, **extra) -> dict:
+        """
+        Return the metrics of the window since the last flush (plus any extra
+        fields, e.g. iter) and start a new window. Returns None if there was
+        nothing to flush.
+
+        With reduce the window is summed over all processes of the default
+        process group first; every rank has to call flush at the same point.
+        """
+        if self.steps == 0:
+            return None
+        totals = torch.stack([self.loss_sum, self.correct.float(), self.tokens.float()])
+        if reduce:
+            dist.all_reduce(totals)
+        loss_sum, correct, tokens = (float(v) for v in totals.tolist())
+        loss = loss_sum / max(tokens, 1)
+        record = dict(extra)
+        record.update(
+            loss=loss,
+            perplexity=math.exp(loss),
+            accuracy=correct / max(tokens, 1),
+            tokens=int(tokens),
+            steps=self.steps,
+            time=time.time(),
+        )
+        self.reset()
+        if self.log_path is not None:
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+        return record
@@ -5,6 +5,21 @@ from typing import Any, Tuple
 # 24, 48, 96, 120, 240, 384, 480, and 960
 COMMON_RESOLUTION=240
 
+# Unpacked forms used by the array versions of the encode/decode functions.
+# Start and end are in seconds (like pretty_midi.Note)
+NOTE_DTYPE = np.dtype([
+    ("start", np.float64),
+    ("end", np.float64),
+    ("pitch", np.int64),
+    ("velocity", np.int64),
+])
+HEADER_DTYPE = np.dtype([
+    ("key", np.int64),
+    ("bpm", np.int64),
+    ("nominator", np.int64),
+    ("denominator", np.int64),
+])
+
 def encode_header(key: int, bpm: int, nominator: int, denominator:int ) -> int:
     """
     |           | KEY       |
@@ -41,6 +56,38 @@ def decode_header(header: int) -> Tuple[int,int,int,int]:
     return (int(key), int(bpm), int(nominator), int(denominator))
 
 
+def encode_headers(headers: np.array) -> np.array:
+    """
+    Array version of encode_header: pack a HEADER_DTYPE structured array
+    into uint32 headers
+    """
+    encoded = (headers["key"] & 255) << 16
+    encoded += (headers["bpm"] & 255) << 8
+    encoded += (headers["nominator"] & 15) << 4
+    encoded += headers["denominator"] & 15
+    return encoded.astype(np.uint32)
+
+
+def decode_headers(encoded: np.array) -> np.array:
+    """
+    Array version of decode_header: unpack uint32 headers into a
+    HEADER_DTYPE structured array
+    """
+    encoded = np.asarray(encoded, dtype=np.int64)
+    headers = np.empty(encoded.shape, dtype=HEADER_DTYPE)
+    headers["key"] = (encoded >> 16) & 255
+    headers["bpm"] = (encoded >> 8) & 255
+    headers["nominator"] = (encoded >> 4) & 15
+    headers["denominator"] = encoded & 15
+    return headers
+
+
+def notes_to_array(notes) -> np.array:
+    """pretty_midi notes (anything with start/end/pitch/velocity) to NOTE_DTYPE"""
+    return np.array(
+        [(n.start, n.end, n.pitch, n.velocity) for n in notes], dtype=NOTE_DTYPE)
+
+
 def encode_note(note: Any, ticks_per_beat: int) -> int:
     if note is None:
         0
@@ -79,6 +126,44 @@ def decode_note(encoded_note: int, ticks_per_beat: int) -> Tuple:
     return (pitch&127, f_step, f_duration, velocity&127)
 
 
+def encode_notes(notes: np.array, ticks_per_beat: int) -> np.array:
+    """
+    Array version of encode_note: pack a NOTE_DTYPE structured array (a whole
+    track, or a whole corpus) into uint32 notes with the same bit layout
+    """
+    # convert seconds into ticks so we can use a common tick
+    start = (notes["start"] * ticks_per_beat).astype(np.int64)
+    end = (notes["end"] * ticks_per_beat).astype(np.int64)
+
+    int_velocity = ((notes["velocity"] / 127) * 15).astype(np.int64) & 15
+    int_step = start & 65535
+    int_duration = (end - start) & 31
+
+    encoded = int_step << 16
+    encoded += int_duration << 11
+    encoded += int_velocity << 7
+    encoded += notes["pitch"]
+    return encoded.astype(np.uint32)
+
+
+def decode_notes(encoded: np.array, ticks_per_beat: int) -> np.array:
+    """
+    Array version of decode_note: unpack uint32 notes into a NOTE_DTYPE
+    structured array
+    """
+    encoded = np.asarray(encoded, dtype=np.int64)
+    int_step = (encoded >> 16) & 65535
+    int_duration = (encoded >> 11) & 31
+    velocity = (encoded >> 7) & 15
+
+    notes = np.empty(encoded.shape, dtype=NOTE_DTYPE)
+    notes["pitch"] = encoded & 127
+    notes["start"] = int_step / ticks_per_beat
+    notes["end"] = notes["start"] + int_duration / ticks_per_beat
+    notes["velocity"] = ((velocity / 15) * 127).astype(np.int64) & 127
+    return notes
+
+
 def extract_midi_metadata(pm) -> Tuple[int,int,int,int]:
     bpm = 120
     key_signature = 0
@@ -114,42 +199,47 @@ def extract_midi_metadata(pm) -> Tuple[int,int,int,int]:
 #     return bpm
 
 
-def calculate_rhythmic_complexity(midi_file, bins=10):
+def drum_tracks(pm) -> list:
+    """the notes of every drum instrument of a parsed file, as NOTE_DTYPE arrays"""
+    # for this project, I am just playing with drums
+    return [notes_to_array(instrument.notes) for instrument in pm.instruments if instrument.is_drum]
+
+
+def rhythmic_features(tracks, bins=10) -> dict:
     """
     Inter-Onset Intervals (IOIs)
     IOIs are the time intervals between the start
     of consecutive notes. They provide insight into the
     rhythmic structure of the music.
+
+    tracks is a list of NOTE_DTYPE arrays (see drum_tracks), IOIs and
+    durations are taken per track and pooled.
     """
-    pm = pretty_midi.PrettyMIDI(midi_file, resolution=COMMON_RESOLUTION)
     bpm = 120
-    iois = []
-    durations = []
-
-    # Iterate over all instruments
-    for instrument in pm.instruments:
-        if instrument.is_drum:
-            # for this project, I am just playing with drums
-            # Sort notes by start time
-            sorted_notes = sorted(instrument.notes, key=lambda note: note.start)
-            # Calculate IOIs and collect durations
-            for i in range(1, len(sorted_notes)):
-                iois.append(sorted_notes[i].start - sorted_notes[i-1].start)
-                durations.append(sorted_notes[i].end - sorted_notes[i].start)
+    iois = [np.empty(0)]
+    durations = [np.empty(0)]
+    for notes in tracks:
+        # Sort notes by start time
+        notes = notes[np.argsort(notes["start"], kind="stable")]
+        # Calculate IOIs and collect durations
+        iois.append(np.diff(notes["start"]))
+        durations.append((notes["end"] - notes["start"])[1:])
+    iois = np.concatenate(iois)
+    durations = np.concatenate(durations)
 
     # Calculate mean and standard deviation of IOIs and durations
     # Calculate the variability in note durations. Higher variability often
     # indicates higher rhythmic complexity.
-    mean_ioi = np.mean(iois) if iois else 0
-    std_ioi = np.std(iois) if iois else 0
-    mean_duration = np.mean(durations) if durations else 0
-    std_duration = np.std(durations) if durations else 0
+    mean_ioi = np.mean(iois) if len(iois) else 0
+    std_ioi = np.std(iois) if len(iois) else 0
+    mean_duration = np.mean(durations) if len(durations) else 0
+    std_duration = np.std(durations) if len(durations) else 0
 
     # Calculate entropy of IOIs and durations
     # Use entropy to measure the unpredictability or randomness in the
     # rhythmic patterns. Higher entropy values suggest higher complexity.
     def calculate_entropy(data):
-        if not data:
+        if not len(data):
             return 0
         try:
             hist, _ = np.histogram(data, bins=bins, density=True)
@@ -159,21 +249,18 @@ def calculate_rhythmic_complexity(midi_file, bins=10):
             return 0
         return entropy
 
-    # normalized_entropy_ioi = normalize(entropy_ioi, 0, max_entropy)
-    # normalized_entropy_duration = normalize(entropy_duration, 0, max_entropy)
     entropy_ioi = calculate_entropy(iois)
     entropy_duration = calculate_entropy(durations)
 
     # Combine metrics to form a rhythmic complexity score
     rhythmic_complexity = (std_ioi + std_duration + entropy_ioi + entropy_duration) / 4
 
-
     # Set a threshold for filtering small IOIs
     # really small events can make the BPM blow out
     threshold = 0.25 # Threshold in seconds
-    filtered_iois = [ioi for ioi in iois if ioi > threshold]
+    filtered_iois = iois[iois > threshold]
     # Calculate the average IOI in seconds
-    avg_ioi = sum(filtered_iois) / len(filtered_iois) if filtered_iois else 0
+    avg_ioi = np.mean(filtered_iois) if len(filtered_iois) else 0
     # Convert average IOI to BPM
     if avg_ioi > 0:
         bpm = round(60 / avg_ioi)
@@ -190,13 +277,27 @@ def calculate_rhythmic_complexity(midi_file, bins=10):
     }
 
 
+def calculate_rhythmic_complexity(midi_file, bins=10):
+    """
+    Rhythmic features of the drum tracks of one file, see rhythmic_features.
+    For a whole corpus use features.extract_features, which parses every
+    file once and caches the results.
+    """
+    pm = pretty_midi.PrettyMIDI(midi_file, resolution=COMMON_RESOLUTION)
+    return rhythmic_features(drum_tracks(pm), bins)
+
+
 def encode_midi(midi_file: str,
                 window_size=64,
-                instrument_name: str = "Standard Kit") -> np.array:
+                instrument_name: str = "Standard Kit",
+                strict: bool = False) -> np.array:
     """
     Encode a midi file into a numpy array of integers using the
     instrument index with a max window size of window_size
     (window size is basically the number of note on events)
+
+    Files that can not be encoded are reported and None is returned,
+    unless strict is set in which case the error is raised.
     """
     try:
         pm = pretty_midi.PrettyMIDI(midi_file)
@@ -227,15 +328,13 @@ def encode_midi(midi_file: str,
         notes = np.zeros(window_size, dtype=np.uint32, order='C')
         notes[0] = header
         # sorted_notes = sorted(instrument.notes, key=lambda note: note.start)
-        sorted_notes = instrument.notes
-
-        for i, note in enumerate(sorted_notes):
-            if i >= (window_size-1):
-                break
-            encoded_note = encode_note(note, COMMON_RESOLUTION)
-            notes[i+1] = encoded_note
+        sorted_notes = notes_to_array(instrument.notes[:window_size-1])
+        encoded_notes = encode_notes(sorted_notes, COMMON_RESOLUTION)
+        notes[1:len(encoded_notes)+1] = encoded_notes
 
     except Exception as e:
+        if strict:
+            raise
         print(f"could not load {midi_file} because {e}")
         return None
 
@@ -282,11 +381,8 @@ def decode_midi(
 
     pm.instruments.append(instrument)
 
-    for i, encoded_note in enumerate(notes):
-        if i == 0:
-            # Skip header
-            continue
-        pitch, start, end, velocity = decode_note(encoded_note, COMMON_RESOLUTION)
+    # Skip header
+    for start, end, pitch, velocity in decode_notes(notes[1:], COMMON_RESOLUTION).tolist():
         note = pretty_midi.Note(
             pitch=pitch,
             start=start,   # should be in seconds not ticks
@@ -299,9 +395,55 @@ def decode_midi(
     return pm
 
 
+# Legacy: one raw file per song. Corpora go into a single note_corpus.py
+# file instead (preprocess.py writes one), these stay for midi_encode.ipynb.
 def serialize_notes(raw_notes: np.array, filename: str):
     raw_notes.astype('int32').tofile(filename)
 
 
 def deserialize_notes(filename: str) -> np.array:
     return np.fromfile(filename, dtype=np.int32)
+
+
+if __name__ == "__main__":
+    # python -m gpt_mini.midi_encoder
+    # the array versions have to give the scalar versions' results bit for
+    # bit, and decoding has to give back what was encoded, as quantized
+    rng = np.random.default_rng(0)
+    n = 1000
+
+    headers = np.empty(n, dtype=HEADER_DTYPE)
+    headers["key"] = rng.integers(0, 24, n)
+    headers["bpm"] = rng.integers(0, 256, n)
+    headers["nominator"] = rng.integers(0, 16, n)
+    headers["denominator"] = rng.integers(0, 16, n)
+    packed = encode_headers(headers)
+    assert packed.tolist() == [encode_header(*h) for h in headers.tolist()]
+    assert decode_headers(packed).tolist() == [decode_header(int(h)) for h in packed]
+    assert decode_headers(packed).tolist() == headers.tolist()
+
+    notes = np.empty(n, dtype=NOTE_DTYPE)
+    notes["start"] = rng.uniform(0, 200, n)
+    # past 31 ticks the duration wraps, which both versions have to agree on
+    notes["end"] = notes["start"] + rng.uniform(0, 0.3, n)
+    notes["pitch"] = rng.integers(0, 128, n)
+    notes["velocity"] = rng.integers(0, 128, n)
+    note_objects = [pretty_midi.Note(v, p, s, e) for s, e, p, v in notes.tolist()]
+    packed = encode_notes(notes, COMMON_RESOLUTION)
+    assert packed.tolist() == [encode_note(note, COMMON_RESOLUTION) for note in note_objects]
+    decoded = decode_notes(packed, COMMON_RESOLUTION)
+    scalar = [decode_note(int(x), COMMON_RESOLUTION) for x in packed]
+    assert decoded[["pitch", "start", "end", "velocity"]].tolist() == scalar
+
+    # round trip: times snap down to the tick, velocity to one of 16 levels
+    short = notes[(notes["end"] * COMMON_RESOLUTION).astype(np.int64)
+                  - (notes["start"] * COMMON_RESOLUTION).astype(np.int64) < 32]
+    decoded = decode_notes(encode_notes(short, COMMON_RESOLUTION), COMMON_RESOLUTION)
+    ticks = (short["start"] * COMMON_RESOLUTION).astype(np.int64)
+    duration = (short["end"] * COMMON_RESOLUTION).astype(np.int64) - ticks
+    assert (decoded["pitch"] == short["pitch"]).all()
+    assert (decoded["start"] == ticks / COMMON_RESOLUTION).all()
+    assert (decoded["end"] == ticks / COMMON_RESOLUTION + duration / COMMON_RESOLUTION).all()
+    level = ((short["velocity"] / 127) * 15).astype(np.int64)
+    assert (decoded["velocity"] == ((level / 15) * 127).astype(np.int64)).all()
+    print(f"scalar and array encodings agree, {len(short)} notes and {n} headers round trip")
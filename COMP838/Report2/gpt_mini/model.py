@@ -12,7 +12,11 @@ import math
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
 from gpt_mini.utils import CfgNode as CN
+from gpt_mini.decoding import TokenSampler
+from gpt_mini.samplers import BucketBatchSampler
+from gpt_mini.speculative import SpeculativeDecoder
 
 
 class NewGELU(nn.Module):
@@ -41,17 +45,67 @@ class CausalSelfAttention(nn.Module):
         # regularization
         self.attn_dropout = nn.Dropout(config.attn_pdrop)
         self.resid_dropout = nn.Dropout(config.resid_pdrop)
-        # causal mask to ensure that attention is only applied to the left in the input sequence
-        self.register_buffer(
-            "bias",
-            torch.tril(torch.ones(config.block_size, config.block_size)).view(
-                1, 1, config.block_size, config.block_size
-            ),
-        )
+        # "reference" is the explicit implementation below, "sdpa" hands the
+        # whole thing to torch's fused scaled_dot_product_attention kernel
+        assert config.attn_backend in ("reference", "sdpa")
+        self.attn_backend = config.attn_backend
+        self.attn_pdrop = config.attn_pdrop
+        if self.attn_backend == "reference":
+            # causal mask to ensure that attention is only applied to the left in the input sequence
+            self.register_buffer(
+                "bias",
+                torch.tril(torch.ones(config.block_size, config.block_size)).view(
+                    1, 1, config.block_size, config.block_size
+                ),
+            )
         self.n_head = config.n_head
         self.n_embd = config.n_embd
-
-    def forward(self, x):
+        self.block_size = config.block_size
+        # key/value cache for incremental decoding (see GPT.generate). When
+        # enabled the keys and values of every position seen so far are kept
+        # in preallocated (B, nh, block_size, hs) buffers and only the new
+        # positions have to be fed through the layer.
+        self.use_kv_cache = False
+        self.kv_cache = None
+        self.kv_len = 0
+
+    def reset_kv_cache(self):
+        self.kv_cache = None
+        self.kv_len = 0
+
+    def select_kv_cache(self, rows):
+        """keep only the given batch rows of the cache (index or bool mask)"""
+        if self.kv_cache is not None:
+            self.kv_cache = tuple(c[rows] for c in self.kv_cache)
+
+    def truncate_kv_cache(self, length):
+        """forget every cached position from length on"""
+        self.kv_len = min(self.kv_len, length)
+
+    def trim_kv_cache(self, n):
+        """forget the first n cached positions, moving the rest to the front"""
+        n = min(n, self.kv_len)
+        if self.kv_cache is not None and n > 0:
+            for c in self.kv_cache:
+                c[:, :, : self.kv_len - n] = c[:, :, n : self.kv_len].clone()
+            self.kv_len -= n
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints saved with the reference backend carry the causal mask
+        # buffer, the fused backend has no use for it. The mask only depends
+        # on block_size, so one missing from an sdpa checkpoint is our own
+        if self.attn_backend != "reference":
+            state_dict.pop(prefix + "bias", None)
+        elif prefix + "bias" not in state_dict:
+            state_dict[prefix + "bias"] = self.bias
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, x, attn_mask=None):
+        """
+        attn_mask, if given, is a (B, 1, T, L) bool tensor that is True where
+        query t may attend to key l. It replaces the plain causal mask (see
+        GPT.forward for how it is built from a padding mask).
+        """
         # batch size, sequence length, embedding dimensionality (n_embd)
         B, T, C = ( x.size() )
 
@@ -64,13 +118,37 @@ class CausalSelfAttention(nn.Module):
         # (B, nh, T, hs)
         v = v.view(B, T, self.n_head, C // self.n_head).transpose(1, 2)
 
-        # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, T) -> (B, nh, T, T)
-        att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
-        att = att.masked_fill(self.bias[:, :, :T, :T] == 0, float("-inf"))
-        att = F.softmax(att, dim=-1)
-        att = self.attn_dropout(att)
-        # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
-        y = att @ v
+        if self.use_kv_cache:
+            if self.kv_cache is None:
+                shape = (B, self.n_head, self.block_size, C // self.n_head)
+                self.kv_cache = (k.new_empty(shape), v.new_empty(shape))
+                self.kv_len = 0
+            assert (
+                self.kv_len + T <= self.block_size
+            ), f"KV cache overflow: {self.kv_len} + {T} > {self.block_size}"
+            k_cache, v_cache = self.kv_cache
+            k_cache[:, :, self.kv_len : self.kv_len + T] = k
+            v_cache[:, :, self.kv_len : self.kv_len + T] = v
+            self.kv_len += T
+            # (B, nh, L, hs) where L is everything seen so far
+            k = k_cache[:, :, : self.kv_len]
+            v = v_cache[:, :, : self.kv_len]
+        # the T queries are the last T of the L key positions
+        L = k.size(2)
+
+        if self.attn_backend == "sdpa":
+            y = self._sdpa(q, k, v, attn_mask)
+        else:
+            # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, L) -> (B, nh, T, L)
+            att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
+            if attn_mask is None:
+                att = att.masked_fill(self.bias[:, :, L - T : L, :L] == 0, float("-inf"))
+            else:
+                att = att.masked_fill(~attn_mask, float("-inf"))
+            att = F.softmax(att, dim=-1)
+            att = self.attn_dropout(att)
+            # (B, nh, T, L) x (B, nh, L, hs) -> (B, nh, T, hs)
+            y = att @ v
         # re-assemble all head outputs side by side
         y = ( y.transpose(1, 2).contiguous().view(B, T, C) )
 
@@ -78,6 +156,36 @@ class CausalSelfAttention(nn.Module):
         y = self.resid_dropout(self.c_proj(y))
         return y
 
+    def _sdpa(self, q, k, v, attn_mask=None):
+        """fused attention, never materialises the (T, L) attention matrix"""
+        T, L = q.size(2), k.size(2)
+        dropout_p = self.attn_pdrop if self.training else 0.0
+        if attn_mask is not None:
+            return F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=dropout_p)
+        if T == L:
+            return F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p, is_causal=True)
+        if T == 1:
+            # a single new query may look at every cached position
+            return F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p)
+        # several new queries against a warm cache: is_causal would align the
+        # mask to the top left, we need it aligned to the bottom right
+        mask = torch.ones(T, L, dtype=torch.bool, device=q.device).tril(L - T)
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=dropout_p)
+
+
+class MLP(nn.Module):
+    """the position-wise feed forward half of a Block"""
+
+    def __init__(self, config):
+        super().__init__()
+        self.c_fc = nn.Linear(config.n_embd, 4 * config.n_embd)
+        self.c_proj = nn.Linear(4 * config.n_embd, config.n_embd)
+        self.act = NewGELU()
+        self.dropout = nn.Dropout(config.resid_pdrop)
+
+    def forward(self, x):
+        return self.dropout( self.c_proj(self.act(self.c_fc(x))) )
+
 
 class Block(nn.Module):
     """an unassuming Transformer block"""
@@ -87,21 +195,11 @@ class Block(nn.Module):
         self.ln_1 = nn.LayerNorm(config.n_embd)
         self.attn = CausalSelfAttention(config)
         self.ln_2 = nn.LayerNorm(config.n_embd)
-        self.mlp = nn.ModuleDict(
-            dict(
-                c_fc=nn.Linear(config.n_embd, 4 * config.n_embd),
-                c_proj=nn.Linear(4 * config.n_embd, config.n_embd),
-                act=NewGELU(),
-                dropout=nn.Dropout(config.resid_pdrop),
-            )
-        )
-        m = self.mlp
-        # MLP forward
-        self.mlpf = lambda x: m.dropout( m.c_proj(m.act(m.c_fc(x))) )
+        self.mlp = MLP(config)
 
-    def forward(self, x):
-        x = x + self.attn(self.ln_1(x))
-        x = x + self.mlpf(self.ln_2(x))
+    def forward(self, x, attn_mask=None):
+        x = x + self.attn(self.ln_1(x), attn_mask)
+        x = x + self.mlp(self.ln_2(x))
         return x
 
 
@@ -123,6 +221,14 @@ class GPT(nn.Module):
         C.embd_pdrop = 0.1
         C.resid_pdrop = 0.1
         C.attn_pdrop = 0.1
+        # attention implementation: "reference" or "sdpa" (fused, no T x T matrix)
+        C.attn_backend = "reference"
+        # share one matrix between the token embedding and the output layer
+        C.tie_weights = False
+        # activation checkpointing for long contexts: 0 keeps every block's
+        # activations for backward; N keeps only the input of each run of N
+        # blocks and recomputes the rest during backward (training only)
+        C.activation_checkpointing = 0
         return C
 
     def __init__(self, config):
@@ -130,6 +236,7 @@ class GPT(nn.Module):
         assert config.vocab_size is not None
         assert config.block_size is not None
         self.block_size = config.block_size
+        self.activation_checkpointing = config.activation_checkpointing
 
         type_given = config.model_type is not None
         params_given = all(
@@ -178,6 +285,8 @@ class GPT(nn.Module):
             )
         )
         self.lm_head = nn.Linear(config.n_embd, config.vocab_size, bias=False)
+        if config.tie_weights:
+            self.lm_head.weight = self.transformer.wte.weight
 
         # init all weights, and apply a special scaled init to the residual projections, per GPT-2 paper
         self.apply(self._init_weights)
@@ -275,8 +384,12 @@ class GPT(nn.Module):
                     # weights of blacklist modules will NOT be weight decayed
                     no_decay.add(fpn)
 
-        # validate that we considered every parameter
+        # validate that we considered every parameter. named_parameters lists a
+        # shared tensor once, so with tie_weights lm_head.weight goes with the
+        # (not decayed) embedding it is tied to
         param_dict = {pn: p for pn, p in self.named_parameters()}
+        decay &= param_dict.keys()
+        no_decay &= param_dict.keys()
         inter_params = decay & no_decay
         union_params = decay | no_decay
         assert (
@@ -304,14 +417,65 @@ class GPT(nn.Module):
         )
         return optimizer
 
-    def forward(self, idx, targets=None):
+    def set_kv_cache(self, enabled: bool):
+        """
+        Switch incremental decoding on or off for every attention layer. Any
+        previously cached keys/values are dropped either way.
+        """
+        for block in self.transformer.h:
+            block.attn.use_kv_cache = enabled
+            block.attn.reset_kv_cache()
+
+    def reset_kv_cache(self):
+        for block in self.transformer.h:
+            block.attn.reset_kv_cache()
+
+    def select_kv_cache(self, rows):
+        for block in self.transformer.h:
+            block.attn.select_kv_cache(rows)
+
+    def truncate_kv_cache(self, length):
+        """roll the caches back to their first length positions (see speculative.py)"""
+        for block in self.transformer.h:
+            block.attn.truncate_kv_cache(length)
+
+    def trim_kv_cache(self, n):
+        """drop the first n cached positions (see generate_batch)"""
+        for block in self.transformer.h:
+            block.attn.trim_kv_cache(n)
+
+    def kv_cache_length(self) -> int:
+        """number of positions currently held in the key/value caches"""
+        return self.transformer.h[0].attn.kv_len
+
+    def forward(self, idx, targets=None, attention_mask=None):
+        """
+        attention_mask is an optional (b, past + t) padding mask, 1 for real
+        tokens and 0 for (left) padding, covering any cached positions too.
+        Padding is never attended to and position embeddings count real
+        tokens only, so a left padded row gives the same result as unpadded.
+        """
         device = idx.device
         b, t = idx.size()
+        # with a warm kv cache idx only holds the new positions
+        past = self.kv_cache_length()
         assert (
-            t <= self.block_size
-        ), f"Cannot forward sequence of length {t}, block size is only {self.block_size}"
-        # shape (1, t)
-        pos = torch.arange(0, t, dtype=torch.long, device=device).unsqueeze( 0 )
+            past + t <= self.block_size
+        ), f"Cannot forward sequence of length {past + t}, block size is only {self.block_size}"
+        attn_mask = None
+        if attention_mask is None:
+            # shape (1, t)
+            pos = torch.arange(past, past + t, dtype=torch.long, device=device).unsqueeze( 0 )
+        else:
+            attention_mask = attention_mask.bool()
+            assert attention_mask.size() == (b, past + t)
+            # shape (b, t)
+            pos = (attention_mask.long().cumsum(1) - 1).clamp(min=0)[:, past:]
+            # (b, 1, t, past + t): causal and not padding. Padding queries are
+            # allowed to see themselves so their softmax stays finite.
+            causal = torch.ones(t, past + t, dtype=torch.bool, device=device).tril(past)
+            diagonal = causal & ~causal.tril(past - 1)
+            attn_mask = (causal & attention_mask[:, None, None, :]) | diagonal
 
         # forward the GPT model itself
         # token embeddings of shape (b, t, n_embd)
@@ -319,8 +483,14 @@ class GPT(nn.Module):
         # position embeddings of shape (1, t, n_embd)
         pos_emb = self.transformer.wpe( pos )
         x = self.transformer.drop(tok_emb + pos_emb)
-        for block in self.transformer.h:
-            x = block(x)
+        n = len(self.transformer.h)
+        if self.activation_checkpointing and self.training and torch.is_grad_enabled():
+            step = self.activation_checkpointing
+            for start in range(0, n, step):
+                # dropout masks are replayed exactly in the recomputation
+                x = checkpoint(self._run_blocks, x, attn_mask, start, start + step, use_reentrant=False)
+        else:
+            x = self._run_blocks(x, attn_mask, 0, n)
         x = self.transformer.ln_f(x)
         logits = self.lm_head(x)
 
@@ -333,40 +503,237 @@ class GPT(nn.Module):
 
         return logits, loss
 
+    def _run_blocks(self, x, attn_mask, start, end):
+        for block in self.transformer.h[start:end]:
+            x = block(x, attn_mask)
+        return x
+
     @torch.no_grad()
     def generate(
-        self, idx, max_new_tokens, temperature=1.0, do_sample=False, top_k=None
+        self,
+        idx,
+        max_new_tokens,
+        temperature=1.0,
+        do_sample=False,
+        top_k=None,
+        use_kv_cache=True,
+        top_p=None,
+        repetition_penalty=1.0,
+        seed=None,
+        sampler=None,
+        draft=None,
+        speculative_k=4,
     ):
         """
         Take a conditioning sequence of indices idx (LongTensor of shape (b,t)) and complete
         the sequence max_new_tokens times, feeding the predictions back into the model each time.
         Most likely you'll want to make sure to be in model.eval() mode of operation for this.
+
+        The sampling arguments build a TokenSampler (see decoding.py), or pass one in as sampler.
+
+        With use_kv_cache the prompt is run through the model once and after that only the
+        newest token is fed each step. Once the sequence no longer fits in block_size the
+        window slides and every position embedding changes, so from then on each step falls
+        back to a full forward over the cropped window (exactly what the uncached path does).
+
+        With a draft model (a smaller GPT over the same vocabulary) and a single sequence,
+        decoding is speculative: the draft proposes speculative_k tokens at a time and this
+        model checks them in one forward (see speculative.py). The tokens follow the same
+        distribution as without it. A draft with more than one sequence is a ValueError.
         """
+        if sampler is None:
+            sampler = TokenSampler(temperature, top_k, top_p, repetition_penalty, do_sample, seed)
+        if draft is not None:
+            if idx.size(0) != 1:
+                raise ValueError(
+                    f"speculative decoding takes a single sequence, got a batch of {idx.size(0)}")
+            return SpeculativeDecoder(self, draft, speculative_k).generate(idx, max_new_tokens, sampler)
+        self.set_kv_cache(use_kv_cache)
+        try:
+            return self._generate(idx, max_new_tokens, sampler)
+        finally:
+            self.set_kv_cache(False)
+
+    def _generate(self, idx, max_new_tokens, sampler):
+        use_kv_cache = self.transformer.h[0].attn.use_kv_cache
         for _ in range(max_new_tokens):
-            # if the sequence context is growing too long we must crop it at block_size
-            idx_cond = (
-                idx if idx.size(1) <= self.block_size else idx[:, -self.block_size :]
-            )
+            if use_kv_cache and 0 < self.kv_cache_length() and idx.size(1) <= self.block_size:
+                # the cache holds everything but the token we sampled last
+                idx_cond = idx[:, -1:]
+            else:
+                self.reset_kv_cache()
+                # if the sequence context is growing too long we must crop it at block_size
+                idx_cond = (
+                    idx if idx.size(1) <= self.block_size else idx[:, -self.block_size :]
+                )
             # forward the model to get the logits for the index in the sequence
             logits, _ = self(idx_cond)
-            try:
-                # pluck the logits at the final step and scale by desired temperature
-                logits = logits[:, -1, :] / temperature
-            except Exception as ex:
-                print(ex, logits)
-                raise ex
-            # optionally crop the logits to only the top k options
-            if top_k is not None:
-                v, _ = torch.topk(logits, top_k)
-                logits[logits < v[:, [-1]]] = -float("Inf")
-            # apply softmax to convert logits to (normalized) probabilities
-            probs = F.softmax(logits, dim=-1)
-            # either sample from the distribution or take the most likely element
-            if do_sample:
-                idx_next = torch.multinomial(probs, num_samples=1)
-            else:
-                _, idx_next = torch.topk(probs, k=1, dim=-1)
+            # pluck the logits at the final step and pick the next index
+            idx_next = sampler(logits[:, -1, :], idx)
             # append sampled index to the running sequence and continue
             idx = torch.cat((idx, idx_next), dim=1)
 
         return idx
+
+    @torch.no_grad()
+    def generate_batch(
+        self,
+        prompts,
+        max_new_tokens,
+        temperature=1.0,
+        do_sample=False,
+        top_k=None,
+        stop_tokens=None,
+        pad_token=0,
+        top_p=None,
+        repetition_penalty=1.0,
+        seed=None,
+        sampler=None,
+        batch_size=None,
+    ):
+        """
+        Complete a list of prompts of different lengths (1d LongTensors or lists
+        of ids) in one batch. The prompts are left padded with pad_token and an
+        attention mask keeps the padding out of the computation, so each row
+        generates what generate() would for that prompt on its own.
+
+        A row is finished once it samples one of stop_tokens (which is kept)
+        or after max_new_tokens, an int for all prompts or a list with one
+        per prompt. Finished rows are dropped from the batch and their kv
+        cache so no more compute is spent on them.
+
+        sampler is a TokenSampler for the whole batch, or a list with one per
+        prompt; with seeded per-prompt samplers each row's completion does not
+        depend on what else is in the batch. Otherwise one is built from the
+        sampling arguments as in generate().
+
+        With batch_size, prompts of similar length are grouped into batches of
+        at most batch_size (see samplers.BucketBatchSampler), so short prompts
+        are not padded out to the longest one.
+
+        Returns a list with prompt + completion per prompt, without padding.
+        """
+        device = self.transformer.wte.weight.device
+        prompts = [torch.as_tensor(p, dtype=torch.long, device=device).view(-1) for p in prompts]
+        if not isinstance(max_new_tokens, (list, tuple)):
+            max_new_tokens = [max_new_tokens] * len(prompts)
+        if sampler is None:
+            sampler = TokenSampler(temperature, top_k, top_p, repetition_penalty, do_sample, seed)
+        if batch_size is not None and len(prompts) > batch_size:
+            results = [None] * len(prompts)
+            for group in BucketBatchSampler([len(p) for p in prompts], batch_size):
+                completions = self.generate_batch(
+                    [prompts[i] for i in group],
+                    [max_new_tokens[i] for i in group],
+                    stop_tokens=stop_tokens,
+                    pad_token=pad_token,
+                    sampler=sampler if isinstance(sampler, TokenSampler) else [sampler[i] for i in group],
+                )
+                for i, completion in zip(group, completions):
+                    results[i] = completion
+            return results
+
+        B, T = len(prompts), max(len(p) for p in prompts)
+        idx = torch.full((B, T), pad_token, dtype=torch.long, device=device)
+        mask = torch.zeros((B, T), dtype=torch.bool, device=device)
+        for i, p in enumerate(prompts):
+            idx[i, T - len(p) :] = p
+            mask[i, T - len(p) :] = True
+        stop = None
+        if stop_tokens:
+            stop = torch.tensor(list(stop_tokens), dtype=torch.long, device=device)
+
+        # rows[i] is the prompt index of active row i, prompts that want no
+        # new tokens are done already
+        limit = torch.tensor(max_new_tokens, dtype=torch.long, device=device)
+        rows = (limit > 0).nonzero()[:, 0]
+        idx, mask = idx[rows], mask[rows]
+        results = [p for p in prompts]
+        self.set_kv_cache(True)
+        try:
+            for step in range(int(limit.max()) if len(rows) else 0):
+                if 0 < self.kv_cache_length() and idx.size(1) <= self.block_size:
+                    logits, _ = self(idx[:, -1:], attention_mask=mask)
+                else:
+                    # first step, or past block_size: (re)run the cropped window
+                    self.reset_kv_cache()
+                    logits, _ = self(
+                        idx[:, -self.block_size :], attention_mask=mask[:, -self.block_size :]
+                    )
+                logits = logits[:, -1, :]
+                if isinstance(sampler, TokenSampler):
+                    idx_next = sampler(logits, idx, mask)
+                else:
+                    idx_next = torch.cat([
+                        sampler[p](logits[r : r + 1], idx[r : r + 1], mask[r : r + 1])
+                        for r, p in enumerate(rows.tolist())
+                    ])
+                idx = torch.cat((idx, idx_next), dim=1)
+                mask = torch.cat((mask, torch.ones_like(idx_next, dtype=torch.bool)), dim=1)
+
+                done = limit[rows] == step + 1
+                if stop is not None:
+                    done |= torch.isin(idx_next[:, 0], stop)
+                if done.any():
+                    for r in done.nonzero()[:, 0].tolist():
+                        results[rows[r]] = idx[r][mask[r]]
+                    keep = ~done
+                    idx, mask, rows = idx[keep], mask[keep], rows[keep]
+                    if len(rows) == 0:
+                        break
+                    self.select_kv_cache(keep)
+                    # columns that are padding in every row left are dead
+                    # weight, and would push the batch past block_size early
+                    pad = int(mask.any(dim=0).int().argmax())
+                    if pad > 0:
+                        # the cache covers the columns from offset up to the last one
+                        offset = idx.size(1) - 1 - self.kv_cache_length()
+                        self.trim_kv_cache(max(pad - offset, 0))
+                        idx, mask = idx[:, pad:], mask[:, pad:]
+        finally:
+            self.set_kv_cache(False)
+
+        return results
+
+
+if __name__ == "__main__":
+    # python -m gpt_mini.model
+    # the sdpa backend has to give the reference backend's logits, for the
+    # same weights, with and without a warm kv cache
+    def nano(attn_backend):
+        config = GPT.get_default_config()
+        config.model_type = "gpt-nano"
+        config.vocab_size = 100
+        config.block_size = 32
+        config.attn_backend = attn_backend
+        return GPT(config).eval()
+
+    torch.manual_seed(0)
+    reference = nano("reference")
+    fused = nano("sdpa")
+    fused.load_state_dict(reference.state_dict())
+    # and back: an sdpa checkpoint has no mask buffers
+    reloaded = nano("reference")
+    reloaded.load_state_dict(fused.state_dict())
+
+    idx = torch.randint(0, 100, (3, 24))
+    padding = torch.ones_like(idx, dtype=torch.bool)
+    padding[1, :5] = False
+    with torch.no_grad():
+        for mask in (None, padding):
+            a, _ = reference(idx, attention_mask=mask)
+            b, _ = fused(idx, attention_mask=mask)
+            assert torch.allclose(a, b, atol=1e-5), (a - b).abs().max()
+            c, _ = reloaded(idx, attention_mask=mask)
+            assert torch.equal(a, c)
+        full, _ = reference(idx)
+
+        # a warm cache, then several queries at once (mask aligned bottom right)
+        # and then a single one
+        for model in (reference, fused):
+            model.set_kv_cache(True)
+            parts = [model(idx[:, :16])[0], model(idx[:, 16:23])[0], model(idx[:, 23:])[0]]
+            model.set_kv_cache(False)
+            cached = torch.cat(parts, dim=1)
+            assert torch.allclose(cached, full, atol=1e-5), (cached - full).abs().max()
+    print("reference and sdpa backends agree")
@@ -0,0 +1,142 @@
+"""
+Single file container for packed note songs (see midi_encoder.encode_midi),
+so jobs over a large corpus open one file instead of one .tofile blob per song.
+
+    | header (32 bytes)                                    |
+    | -------------------------------------------------- |
+    | magic "PNC1" | version | window_size | reserved     |
+    | count (u64)                | table_pos (u64)       |
+    |----------------------------------------------------|
+    | song data, uint32 packed notes ...                 |
+    |----------------------------------------------------|
+    | table: count x (byte offset, length) u64 pairs     |
+
+Appending writes the new songs and a new table at the end of the file and
+only then rewrites the header, so a crash mid-append leaves the previous
+state readable. The superseded table stays behind as dead space.
+"""
+
+import os
+import struct
+
+import numpy as np
+
+MAGIC = b"PNC1"
+VERSION = 1
+HEADER = struct.Struct("<4sIIIQQ")
+# notes as midi_encoder.encode_notes packs them (not midi_encoder.NOTE_DTYPE)
+PACKED_DTYPE = np.dtype("<u4")
+TABLE_DTYPE = np.dtype("<u8")
+
+
+def _read_header(f):
+    magic, version, window_size, _, count, table_pos = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC:
+        raise ValueError(f"not a packed note corpus (magic {magic!r})")
+    if version != VERSION:
+        raise ValueError(f"unsupported corpus version {version}")
+    return window_size, count, table_pos
+
+
+class NoteCorpus:
+    """
+    Read side of the container. The file is memory mapped and song i is a
+    zero copy uint32 view, so random access is O(1).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self.window_size, self.count, table_pos = _read_header(f)
+        if self.count:
+            self.table = np.memmap(
+                path, dtype=TABLE_DTYPE, mode="r", offset=table_pos, shape=(self.count, 2))
+            self.data = np.memmap(path, dtype=np.uint8, mode="r")
+        else:
+            self.table = np.zeros((0, 2), dtype=TABLE_DTYPE)
+            self.data = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i: int) -> np.array:
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError(f"song {i} out of range for corpus of {self.count}")
+        offset, length = (int(v) for v in self.table[i])
+        return self.data[offset : offset + length * PACKED_DTYPE.itemsize].view(PACKED_DTYPE)
+
+    def lengths(self) -> np.array:
+        return np.asarray(self.table[:, 1], dtype=np.int64)
+
+    @staticmethod
+    def create(path: str, window_size: int) -> "NoteCorpusWriter":
+        """start a new (empty) corpus file, replacing any existing one"""
+        with open(path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, window_size, 0, 0, HEADER.size))
+        return NoteCorpusWriter(path)
+
+
+class NoteCorpusWriter:
+    """
+    Append mode for incremental ingestion. Songs are buffered and written on
+    flush() / close(); use it as a context manager.
+    """
+
+    def __init__(self, path: str, window_size: int = None):
+        if not os.path.exists(path):
+            NoteCorpus.create(path, window_size or 0).close()
+        self.path = path
+        self.f = open(path, "r+b")
+        self.window_size, self.count, table_pos = _read_header(self.f)
+        self.f.seek(table_pos)
+        self.table = np.fromfile(self.f, dtype=TABLE_DTYPE, count=2 * self.count).reshape(-1, 2)
+        self.pending = []
+
+    def append(self, notes: np.array):
+        self.pending.append(np.ascontiguousarray(notes, dtype=PACKED_DTYPE))
+
+    def extend(self, songs):
+        for notes in songs:
+            self.append(notes)
+
+    def flush(self):
+        if not self.pending:
+            return
+        self.f.seek(0, os.SEEK_END)
+        rows = []
+        for notes in self.pending:
+            rows.append((self.f.tell(), len(notes)))
+            notes.tofile(self.f)
+        # keep the table 8 byte aligned
+        self.f.write(b"\0" * (-self.f.tell() % TABLE_DTYPE.itemsize))
+        table_pos = self.f.tell()
+        self.table = np.concatenate([self.table, np.array(rows, dtype=TABLE_DTYPE)])
+        self.table.tofile(self.f)
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        # the header is the commit point
+        self.count = len(self.table)
+        self.f.seek(0)
+        self.f.write(HEADER.pack(MAGIC, VERSION, self.window_size, 0, self.count, table_pos))
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.pending = []
+
+    def close(self):
+        if self.f.closed:
+            return
+        self.flush()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_corpus(path: str, songs, window_size: int):
+    with NoteCorpus.create(path, window_size) as writer:
+        writer.extend(songs)
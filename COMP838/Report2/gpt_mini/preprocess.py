@@ -0,0 +1,233 @@
+"""
+Batch encoding of a midi corpus (e.g. the Lakh lmd_full dataset) into the drum
+files and index the tokenizer is trained on. This is the library/CLI version of
+what 0_midi_encode_batch.ipynb does in a single process:
+
+    python -m gpt_mini.preprocess --workers=16 --max_items=None
+
+Every file is encoded (and written back out as a drum-only midi file) in a
+process pool with a bounded number of files in flight. Results are flushed in
+chunks: the packed notes of a chunk are appended to one note corpus file (see
+note_corpus.py) and one line per source file is appended to the manifest. The
+manifest is the source of truth, so an interrupted run picks up where the last
+flushed chunk left off, and the index file and the failed-file sidecar are
+rebuilt from it at the end. Songs a crash left in the corpus without a manifest
+line are never referenced and just take up space.
+"""
+
+import os
+import json
+import logging
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+
+import gpt_mini.midi_encoder as me
+from gpt_mini.config import CONFIG
+from gpt_mini.note_corpus import NoteCorpus, NoteCorpusWriter
+from gpt_mini.utils import CfgNode as CN
+
+logger = logging.getLogger(__name__)
+
+
+def get_default_config():
+    C = CN()
+    C.dataset = CONFIG["preprocess"]["dataset"]
+    C.window_size = CONFIG["preprocess"]["window_size"]
+    # stop after this many successfully encoded files (None for all of them)
+    C.max_items = CONFIG["preprocess"]["max_dataset_items"]
+    C.instrument_name = "Standard Kit"
+    # where the drum-only midi files are written
+    C.out_dir = "drums"
+    # list of written midi files, one per line (what the tokenizer reads)
+    C.index = CONFIG["preprocess"]["new_dataset_index"]
+    # packed notes of every encoded file, see note_corpus.py
+    C.corpus = "encoded/notes.pnc"
+    # where manifests written before the corpus file kept chunk_XXXXXX.npy
+    C.chunk_dir = "encoded"
+    # files per flush to the corpus and manifest
+    C.chunk_size = 512
+    C.manifest = "encoded/manifest.jsonl"
+    # source files that could not be encoded, tab separated with the error
+    C.failed = "encoded/failed.tsv"
+    C.workers = os.cpu_count()
+    # files submitted to the pool but not yet collected
+    C.max_pending = None
+    return C
+
+
+def _out_file(config, path: Path) -> str:
+    # derived from the source path so it does not depend on completion order
+    rel = path.relative_to(config.dataset).with_suffix("")
+    return os.path.join(config.out_dir, "_".join(rel.parts) + ".mid")
+
+
+def _encode_one(source: str, out_file: str, window_size: int, instrument_name: str):
+    try:
+        notes = me.encode_midi(
+            midi_file=source,
+            window_size=window_size,
+            instrument_name=instrument_name,
+            strict=True)
+        me.decode_midi(notes=notes, out_file=out_file, instrument_name=instrument_name)
+    except Exception as e:
+        return source, out_file, None, f"{type(e).__name__}: {e}"
+    return source, out_file, notes, None
+
+
+def load_manifest(manifest: str, repair: bool = False):
+    """
+    The manifest entries. A crash while appending can leave the last line
+    cut short (no newline yet): it is ignored, so its sources count as not
+    done, and with repair it is cut off the file so the next append starts
+    on a fresh line. Only the encoder, which owns the file, should repair.
+    """
+    entries = []
+    if not os.path.exists(manifest):
+        return entries
+    with open(manifest, "r+b" if repair else "rb") as f:
+        data = f.read()
+        complete = data.rfind(b"\n") + 1
+        if complete < len(data):
+            logger.warning("%s: ignoring an incomplete last line (interrupted write)", manifest)
+            if repair:
+                f.truncate(complete)
+    for line in data[:complete].decode("utf-8").splitlines():
+        line = line.strip()
+        if line:
+            entries.append(json.loads(line))
+    return entries
+
+
+class _ChunkWriter:
+
+    def __init__(self, config, entries):
+        self.config = config
+        self.corpus = NoteCorpusWriter(config.corpus, config.window_size)
+        assert self.corpus.window_size == config.window_size, \
+            f"{config.corpus} holds windows of {self.corpus.window_size}, not {config.window_size}"
+        self.n_ok = sum(1 for e in entries if "error" not in e)
+        self.ok = []
+        self.failed = []
+
+    def add(self, source, out_file, notes, error):
+        if error is None:
+            self.ok.append((source, out_file, notes))
+            self.n_ok += 1
+        else:
+            logger.warning("could not encode %s: %s", source, error)
+            self.failed.append((source, error))
+        if len(self.ok) + len(self.failed) >= self.config.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.ok and not self.failed:
+            return
+        entries = []
+        if self.ok:
+            first = self.corpus.count
+            self.corpus.extend(notes for _, _, notes in self.ok)
+            self.corpus.flush()
+            for i, (source, out_file, _) in enumerate(self.ok):
+                entries.append({"source": source, "out": out_file, "song": first + i})
+        for source, error in self.failed:
+            entries.append({"source": source, "error": error})
+        # appending to the manifest is the commit point of the chunk
+        with open(self.config.manifest, "a", encoding="utf-8") as f:
+            f.write("".join(json.dumps(e) + "\n" for e in entries))
+        self.ok = []
+        self.failed = []
+
+    def close(self):
+        self.flush()
+        self.corpus.close()
+
+
+def encode_corpus(config):
+    """
+    Encode config.dataset in parallel, resuming from config.manifest if it
+    exists. Returns the number of successfully encoded files.
+    """
+    for d in (config.out_dir, os.path.dirname(config.corpus), os.path.dirname(config.manifest)):
+        if d:
+            os.makedirs(d, exist_ok=True)
+
+    entries = load_manifest(config.manifest, repair=True)
+    done = {e["source"] for e in entries}
+    writer = _ChunkWriter(config, entries)
+    if done:
+        print(f"resuming: {len(done)} files already processed, {writer.n_ok} encoded")
+
+    max_items = config.max_items
+    max_pending = config.max_pending or 4 * config.workers
+
+    def limit_reached(in_flight=0):
+        return max_items is not None and writer.n_ok + in_flight >= max_items
+
+    with ProcessPoolExecutor(max_workers=config.workers) as pool:
+        pending = set()
+
+        def collect(return_when):
+            nonlocal pending
+            finished, pending = wait(pending, return_when=return_when)
+            for future in finished:
+                writer.add(*future.result())
+
+        for path in Path(config.dataset).rglob("*.mid"):
+            if str(path) in done:
+                continue
+            # keep the queue bounded, and don't encode more than we need
+            while pending and (len(pending) >= max_pending or limit_reached(len(pending))):
+                collect(FIRST_COMPLETED)
+            if limit_reached():
+                break
+            pending.add(pool.submit(
+                _encode_one,
+                str(path),
+                _out_file(config, path),
+                config.window_size,
+                config.instrument_name))
+
+        while pending:
+            collect(FIRST_COMPLETED)
+    writer.close()
+
+    # rebuild the index and failed sidecar from the manifest
+    entries = load_manifest(config.manifest)
+    with open(config.index, "w", encoding="utf-8") as f:
+        f.write("".join(e["out"] + "\n" for e in entries if "error" not in e))
+    with open(config.failed, "w", encoding="utf-8") as f:
+        f.write("".join(f"{e['source']}\t{e['error']}\n" for e in entries if "error" in e))
+
+    print(f"encoded {writer.n_ok} files into {config.index}")
+    return writer.n_ok
+
+
+def load_encoded(config) -> np.array:
+    """all packed note windows recorded in the manifest, in manifest order"""
+    entries = [e for e in load_manifest(config.manifest) if "error" not in e]
+    if not entries:
+        return np.zeros((0, config.window_size), dtype=np.uint32)
+    corpus = NoteCorpus(config.corpus) if any("song" in e for e in entries) else None
+    chunks = {}
+
+    def window(e):
+        if "song" in e:
+            return corpus[e["song"]]
+        # written by an older version, one .npy per chunk
+        if e["chunk"] not in chunks:
+            chunks[e["chunk"]] = np.load(
+                os.path.join(config.chunk_dir, f"chunk_{e['chunk']:06d}.npy"), mmap_mode="r")
+        return chunks[e["chunk"]][e["row"]]
+
+    return np.stack([window(e) for e in entries])
+
+
+if __name__ == "__main__":
+    import sys
+
+    logging.basicConfig()
+    config = get_default_config()
+    config.merge_from_args(sys.argv[1:])
+    encode_corpus(config)
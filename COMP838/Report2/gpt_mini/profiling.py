@@ -0,0 +1,207 @@
+"""
+Throughput, memory and per-module timing for the Trainer, to tell a run
+that is starving on data loading apart from one that is bound by the model.
+
+Turned on with Trainer config profile=True, every profile_interval
+iterations the Trainer publishes TrainingProfiler.report() as
+trainer.profile_report and fires on_profile. A torch.profiler trace of a
+window of iterations can be written as well (profile_trace_dir), open it in
+chrome://tracing or https://ui.perfetto.dev.
+"""
+
+import os
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import torch
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+
+def peak_rss_mb() -> float:
+    """peak resident set size of this process, None where it is not available"""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+class ModuleTimer:
+    """
+    Wall time spent in forward and backward of every module whose class name
+    is in names, summed per class. Uses forward (pre) hooks and full backward
+    (pre) hooks; on cuda each hook synchronizes so the times are those of
+    the kernels, which slows training down somewhat while attached.
+
+    Only the training step is timed: forward hooks count while phase is
+    "forward" and backward hooks while it is "backward" (see
+    TrainingProfiler.phase), and only for modules in training mode. So
+    validation, also on a copy of the model that carries the hooks along, and
+    the forward recomputed by activation checkpointing (which runs in the
+    backward phase and is part of its time) are left out.
+    """
+
+    def __init__(self, model: torch.nn.Module, names):
+        self.names = set(names)
+        self.sync = any(p.is_cuda for p in model.parameters())
+        self.totals = defaultdict(float)
+        self.phase = None
+        self._start = {}
+        self._handles = []
+        for module in model.modules():
+            name = type(module).__name__
+            if name in self.names:
+                self._handles += [
+                    module.register_forward_pre_hook(self._begin("forward")),
+                    module.register_forward_hook(self._end("forward", name)),
+                    module.register_full_backward_pre_hook(self._begin("backward")),
+                    module.register_full_backward_hook(self._end("backward", name)),
+                ]
+
+    def _now(self):
+        if self.sync:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _begin(self, phase):
+        def hook(module, *args):
+            if self.phase == phase and module.training:
+                self._start[(id(module), phase)] = self._now()
+        return hook
+
+    def _end(self, phase, name):
+        def hook(module, *args):
+            start = self._start.pop((id(module), phase), None)
+            if start is not None:
+                self.totals[(name, phase)] += self._now() - start
+        return hook
+
+    def reset(self):
+        self.totals.clear()
+
+    def remove(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+
+class TrainingProfiler:
+    """
+    Accumulates per iteration timings, split into time spent waiting on the
+    DataLoader (including the copy to the device) and the rest (forward,
+    backward, optimizer step), and the number of samples / tokens trained
+    on. report() summarises the window since the last report.
+
+    module_names: if given, the forward/backward time of the modules with
+    those class names is measured as well (see ModuleTimer).
+    """
+
+    def __init__(self, model, device="cpu", module_names=None, trace_dir=None,
+                 trace_start=10, trace_steps=5):
+        self.device = device
+        self.modules = ModuleTimer(model, module_names) if module_names else None
+        self.trace_dir = trace_dir
+        self.trace_start = trace_start
+        self.trace_steps = trace_steps
+        self.trace_path = None
+        self._trace = None
+        self._step_start = None
+        self._paused = 0.0
+        self.reset()
+
+    def reset(self):
+        self.steps = 0
+        self.samples = 0
+        self.tokens = 0
+        self.data_time = 0.0
+        self.step_time = 0.0
+        if self.modules is not None:
+            self.modules.reset()
+
+    def step_begin(self, iter_num: int):
+        self._step_start = time.perf_counter()
+        self._paused = 0.0
+        if self.trace_dir is not None and iter_num == self.trace_start:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.device(self.device).type == "cuda":
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._trace = torch.profiler.profile(
+                activities=activities, record_shapes=True, profile_memory=True, with_stack=False)
+            self._trace.__enter__()
+
+    def step_end(self, iter_num: int, data_time: float, samples: int, tokens: int):
+        self.steps += 1
+        self.step_time += time.perf_counter() - self._step_start - self._paused
+        self.data_time += data_time
+        self.samples += samples
+        self.tokens += tokens
+        if self._trace is not None and iter_num == self.trace_start + self.trace_steps - 1:
+            self._stop_trace(iter_num)
+
+    @contextmanager
+    def phase(self, name: str):
+        """run the "forward" or "backward" part of a step, for the module timings"""
+        if self.modules is not None:
+            self.modules.phase = name
+        try:
+            yield
+        finally:
+            if self.modules is not None:
+                self.modules.phase = None
+
+    @contextmanager
+    def paused(self):
+        """leave what runs inside (validation) out of the current step's time"""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._paused += time.perf_counter() - t0
+
+    def _stop_trace(self, iter_num):
+        self._trace.__exit__(None, None, None)
+        os.makedirs(self.trace_dir, exist_ok=True)
+        self.trace_path = os.path.join(
+            self.trace_dir, f"trace_{self.trace_start}_{iter_num}.json")
+        self._trace.export_chrome_trace(self.trace_path)
+        self._trace = None
+
+    def report(self, **extra) -> dict:
+        """summary of the window since the last report, which starts a new one"""
+        if self.steps == 0:
+            return None
+        elapsed = max(self.step_time, 1e-9)
+        record = dict(extra)
+        record.update(
+            steps=self.steps,
+            samples_per_sec=self.samples / elapsed,
+            tokens_per_sec=self.tokens / elapsed,
+            step_ms=1000 * self.step_time / self.steps,
+            data_ms=1000 * self.data_time / self.steps,
+            compute_ms=1000 * (self.step_time - self.data_time) / self.steps,
+            data_fraction=self.data_time / elapsed,
+            peak_rss_mb=peak_rss_mb(),
+        )
+        if torch.device(self.device).type == "cuda":
+            record["peak_allocated_mb"] = torch.cuda.max_memory_allocated() / 2**20
+            torch.cuda.reset_peak_memory_stats()
+        if self.modules is not None:
+            record["modules"] = {
+                f"{name}.{phase}_ms": 1000 * total / self.steps
+                for (name, phase), total in sorted(self.modules.totals.items())
+            }
+        self.reset()
+        return record
+
+    def close(self, iter_num: int):
+        if self._trace is not None:
+            # the run ended inside the trace window
+            self._stop_trace(iter_num)
+        if self.modules is not None:
+            self.modules.remove()
@@ -0,0 +1,201 @@
+"""
+Post-training int8 quantization of a trained GPT for CPU inference.
+
+Two methods, both replacing the nn.Linear layers (attn.c_attn, attn.c_proj,
+mlp.c_fc, mlp.c_proj and lm_head) and leaving everything else in float32:
+
+- "dynamic": torch's dynamic quantization. int8 weights, activations are
+  quantized on the fly per batch and the matmuls run in int8. This is the
+  one that makes inference faster.
+- "weight_only": int8 weights with a float scale per output channel,
+  dequantized inside the matmul. Only saves memory (4x on the linear
+  weights), for machines without a quantized engine.
+
+The result is still a GPT, generate() and generate_batch() work as before.
+With tie_weights the int8 lm_head becomes a separate copy of the (float)
+embedding.
+
+    python -m gpt_mini.quantize --checkpoint=checkpoints/best.pt --out=checkpoints/gpt_int8.pt
+
+evaluates fp32 against int8 on the pre-tokenized validation set (see
+bpe.pretokenize), reports generation latency and writes the quantized
+weights, which load_quantized() reads back.
+"""
+
+import io
+import copy
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.data.dataloader import DataLoader
+
+from gpt_mini.config import CONFIG
+from gpt_mini.metrics import Metrics
+from gpt_mini.utils import CfgNode as CN
+
+METHODS = ("dynamic", "weight_only")
+
+
+class Int8Linear(nn.Module):
+    """weight-only int8 replacement for nn.Linear (symmetric, per output channel)"""
+
+    def __init__(self, in_features, out_features, bias=True):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.register_buffer("weight", torch.zeros(out_features, in_features, dtype=torch.int8))
+        self.register_buffer("scale", torch.ones(out_features))
+        self.register_buffer("bias", torch.zeros(out_features) if bias else None)
+
+    @classmethod
+    def from_float(cls, linear: nn.Linear):
+        q = cls(linear.in_features, linear.out_features, linear.bias is not None)
+        w = linear.weight.detach().float()
+        scale = w.abs().amax(dim=1).clamp(min=1e-8) / 127
+        q.weight.copy_(torch.round(w / scale[:, None]).clamp(-127, 127).to(torch.int8))
+        q.scale.copy_(scale)
+        if linear.bias is not None:
+            q.bias.copy_(linear.bias.detach())
+        return q
+
+    def forward(self, x):
+        # the scale is per output channel, so it can be applied after the matmul
+        y = F.linear(x, self.weight.to(x.dtype)) * self.scale.to(x.dtype)
+        return y if self.bias is None else y + self.bias.to(x.dtype)
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}"
+
+
+def _replace_linear(module: nn.Module):
+    for name, child in module.named_children():
+        if isinstance(child, nn.Linear):
+            setattr(module, name, Int8Linear.from_float(child))
+        else:
+            _replace_linear(child)
+
+
+def quantize_model(model: nn.Module, method: str = "dynamic") -> nn.Module:
+    """return an int8 copy of model for inference (the original is untouched)"""
+    assert method in METHODS, f"method must be one of {METHODS}"
+    model = copy.deepcopy(model).cpu().eval()
+    if method == "dynamic":
+        from torch.ao.quantization import quantize_dynamic
+
+        return quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    _replace_linear(model)
+    return model
+
+
+def model_size_mb(model: nn.Module) -> float:
+    """size of the serialized state dict"""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 2**20
+
+
+def save_quantized(model: nn.Module, path: str, model_config, method: str):
+    torch.save(
+        {"method": method, "model_config": model_config.to_dict(), "model": model.state_dict()},
+        path,
+    )
+
+
+def load_quantized(path: str) -> nn.Module:
+    """rebuild a model written by save_quantized"""
+    from gpt_mini.model import GPT
+
+    state = torch.load(path, map_location="cpu", weights_only=False)
+    model_config = GPT.get_default_config()
+    model_config.merge_from_dict(state["model_config"])
+    # GPT.__init__ filled in the preset's n_layer / n_head / n_embd already
+    model_config.model_type = None
+    model = quantize_model(GPT(model_config), state["method"])
+    model.load_state_dict(state["model"])
+    return model
+
+
+def evaluate(model: nn.Module, loader, max_batches=None) -> dict:
+    """mean loss, perplexity and accuracy over (at most max_batches of) loader"""
+    model.eval()
+    metrics = Metrics()
+    with torch.no_grad():
+        for i, (x, y) in enumerate(loader):
+            if max_batches is not None and i >= max_batches:
+                break
+            logits, loss = model(x, y)
+            metrics.update(loss, logits, y)
+    return metrics.flush()
+
+
+def latency(model: nn.Module, prompt: torch.Tensor, new_tokens: int, repeats: int = 3) -> dict:
+    """median forward time over the prompt and generate time per new token, in ms"""
+
+    def median_time(fn):
+        fn()  # warmup
+        times = []
+        for _ in range(repeats):
+            t0 = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - t0)
+        return sorted(times)[len(times) // 2]
+
+    model.eval()
+    with torch.no_grad():
+        forward_s = median_time(lambda: model(prompt))
+    generate_s = median_time(lambda: model.generate(prompt, new_tokens))
+    return dict(forward_ms=1000 * forward_s, generate_ms_per_token=1000 * generate_s / new_tokens)
+
+
+def get_default_config():
+    C = CN()
+    # trained weights: a state dict, or a Trainer checkpoint / best.pt
+    C.checkpoint = "./checkpoints/best.pt"
+    C.method = "dynamic"
+    C.out = "./checkpoints/gpt_int8.pt"
+    # prefix of the pre-tokenized validation set, None to skip the evaluation
+    C.data = CONFIG["preprocess"]["tokens_validation"]
+    C.batch_size = 16
+    C.max_batches = None
+    # latency: generate new_tokens after a prompt of prompt_length tokens
+    C.prompt_length = 64
+    C.new_tokens = 64
+    C.threads = None
+    return C
+
+
+if __name__ == "__main__":
+    import sys
+    from gpt_mini.bpe import MemmapMidiDataset
+    from gpt_mini.vocab import load_checkpoint
+
+    config = get_default_config()
+    config.merge_from_args(sys.argv[1:])
+    if config.threads is not None:
+        torch.set_num_threads(config.threads)
+
+    model, model_config = load_checkpoint(config.checkpoint)
+
+    qmodel = quantize_model(model, config.method)
+    save_quantized(qmodel, config.out, model_config, config.method)
+    print(f"wrote {config.out}")
+
+    report = {"fp32": {"size_mb": model_size_mb(model)}, "int8": {"size_mb": model_size_mb(qmodel)}}
+    prompt = torch.randint(0, model_config.vocab_size, (1, config.prompt_length))
+    if config.data is not None:
+        dataset = MemmapMidiDataset(config.data, model_config.block_size)
+        loader = DataLoader(dataset, batch_size=config.batch_size, shuffle=False)
+        for name, m in (("fp32", model), ("int8", qmodel)):
+            report[name].update(evaluate(m, loader, config.max_batches))
+        # a real prompt from the validation set
+        prompt = dataset[0][0][: config.prompt_length].unsqueeze(0)
+    for name, m in (("fp32", model), ("int8", qmodel)):
+        report[name].update(latency(m, prompt, config.new_tokens))
+
+    for key in ("size_mb", "loss", "perplexity", "accuracy", "forward_ms", "generate_ms_per_token"):
+        if key in report["fp32"]:
+            fp32, int8 = report["fp32"][key], report["int8"][key]
+            ratio = f"({int8 / fp32:.3f}x)" if fp32 else ""
+            print(f"{key:>22}: fp32 {fp32:10.4f}  int8 {int8:10.4f}  {ratio}")
@@ -0,0 +1,104 @@
+"""
+Samplers for the Trainer's DataLoaders.
+"""
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+from torch.utils.data.dataloader import default_collate
+
+
+class ResumableRandomSampler(Sampler):
+    """
+    Same as RandomSampler(replacement=True, num_samples=...) except that the
+    order is a pure function of (seed, epoch), and iteration can start part
+    way into an epoch. That is what lets the Trainer resume a run with the
+    exact same batches it would have seen had it never stopped.
+
+    For data parallel training every rank draws the same epoch and takes
+    every world_size-th sample of it, starting at its rank. The epoch is
+    rounded up to a multiple of world_size so all ranks get equal shares.
+    """
+
+    def __init__(self, data_source, num_samples: int, seed: int = 0, rank: int = 0, world_size: int = 1):
+        self.data_source = data_source
+        self.num_samples = num_samples
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch: int, start: int = 0):
+        """iterate epoch, skipping its first start samples"""
+        self.epoch = epoch
+        self.start = start
+
+    def indices(self) -> torch.Tensor:
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        total = self.samples_per_rank() * self.world_size
+        indices = torch.randint(len(self.data_source), (total,), generator=g)
+        return indices[self.rank :: self.world_size]
+
+    def samples_per_rank(self) -> int:
+        return -(-self.num_samples // self.world_size)
+
+    def __iter__(self):
+        yield from self.indices()[self.start :].tolist()
+
+    def __len__(self):
+        return self.samples_per_rank() - self.start
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batches of indices of similar length: the items are sorted by length
+    (lengths[i] is the number of real tokens of item i, see the datasets'
+    lengths()) and cut into batches of batch_size, so that with trim_collate
+    a batch is only as long as its longest member instead of the full block.
+
+    With shuffle the batch order is a random permutation, drawn from seed
+    and epoch (see set_epoch), so the first few batches are not just the
+    shortest items. The batches themselves stay the same.
+    """
+
+    def __init__(self, lengths, batch_size: int, shuffle: bool = False, seed: int = 0, drop_last: bool = False):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        order = np.argsort(self.lengths, kind="stable")
+        self.batches = [
+            order[i : i + batch_size].tolist() for i in range(0, len(order), batch_size)
+        ]
+        if drop_last and self.batches and len(self.batches[-1]) < batch_size:
+            self.batches.pop()
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __iter__(self):
+        if not self.shuffle:
+            yield from self.batches
+            return
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        for i in torch.randperm(len(self.batches), generator=g).tolist():
+            yield self.batches[i]
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def trim_collate(batch, ignore_index: int = -1):
+    """
+    default_collate for (x, y) pairs, then cut the columns past the last
+    real target (targets equal to ignore_index are padding) off the batch.
+    Causal attention means the remaining positions come out exactly the same.
+    """
+    x, y = default_collate(batch)
+    valid = (y != ignore_index).any(dim=0).nonzero()
+    length = int(valid[-1]) + 1 if len(valid) else 1
+    return x[:, :length].contiguous(), y[:, :length].contiguous()
@@ -0,0 +1,400 @@
+"""
+Local HTTP inference server for a trained GPT (standard library asyncio,
+no web framework).
+
+Requests that arrive close together are coalesced into one micro-batch
+and completed by a single GPT.generate_batch call: the first request of a
+batch waits at most max_wait_ms for others to join, up to max_batch of
+them. The model runs on one worker thread, so while a batch generates the
+next one is already filling up.
+
+    python -m gpt_mini.server --checkpoint=checkpoints/best.pt --port=8000
+
+    POST /generate   body: a midi file, returns the generated midi file
+                     with Content-Type: application/json the body is
+                     {"tokens": [...]} and the reply {"tokens": [...]}
+                     query: steps, temperature, top_k, top_p,
+                     repetition_penalty, do_sample, seed
+    GET  /metrics    latency percentiles, batch sizes and throughput
+    GET  /health     {"ok": true, "vocab_size": ..., "block_size": ...}
+
+Every request gets its own seeded TokenSampler, so the same request returns
+the same drums whatever it was batched with. See loadgen.py to put load
+on it.
+"""
+
+import json
+import time
+import asyncio
+import logging
+from collections import deque
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from gpt_mini.config import CONFIG
+from gpt_mini.decoding import TokenSampler
+from gpt_mini.utils import CfgNode as CN
+
+logger = logging.getLogger(__name__)
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+async def read_message(reader: asyncio.StreamReader, max_body: int = None):
+    """
+    Read one HTTP/1.1 request or response: (start line, headers, body).
+    Headers are lower cased. Returns None at the end of the stream.
+    """
+    line = await reader.readline()
+    if not line:
+        return None
+    start = line.decode("latin-1").rstrip("\r\n")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0))
+    if max_body is not None and length > max_body:
+        raise HTTPError(413, f"body over {max_body} bytes")
+    body = await reader.readexactly(length) if length else b""
+    return start, headers, body
+
+
+def _percentiles(values) -> dict:
+    if not values:
+        return {}
+    p50, p95, p99 = np.percentile(np.asarray(values), [50, 95, 99])
+    return dict(p50=p50, p95=p95, p99=p99, mean=float(np.mean(values)))
+
+
+class ServerMetrics:
+    """counters since start plus the latencies (ms) of the last window requests"""
+
+    def __init__(self, window: int = 10000):
+        self.start = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.tokens = 0
+        self.latency_ms = deque(maxlen=window)
+        self.queue_ms = deque(maxlen=window)
+        self.batch_ms = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+
+    def snapshot(self) -> dict:
+        uptime = time.time() - self.start
+        return dict(
+            uptime_s=uptime,
+            requests=self.requests,
+            errors=self.errors,
+            batches=self.batches,
+            generated_tokens=self.tokens,
+            requests_per_s=self.requests / uptime,
+            tokens_per_s=self.tokens / uptime,
+            mean_batch_size=float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0,
+            latency_ms=_percentiles(self.latency_ms),
+            queue_ms=_percentiles(self.queue_ms),
+            batch_ms=_percentiles(self.batch_ms),
+        )
+
+
+class Pending:
+    """one queued request"""
+
+    def __init__(self, prompt, steps: int, sampler: TokenSampler, future):
+        self.prompt = prompt
+        self.steps = steps
+        self.sampler = sampler
+        self.future = future
+        self.arrived = time.perf_counter()
+
+
+class GenerationServer:
+    """
+    Serves model (a GPT) over HTTP. tokenizer is only needed for midi in and
+    out, JSON requests work without one.
+    """
+
+    def __init__(self, model, tokenizer=None, token_cache=None, max_batch=8, max_wait_ms=10.0,
+                 default_steps=64, max_steps=1024, max_body=1 << 20, defaults=None):
+        self.model = model.eval()
+        self.tokenizer = tokenizer
+        self.token_cache = token_cache
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.default_steps = default_steps
+        self.max_steps = max_steps
+        self.max_body = max_body
+        # sampling arguments for requests that do not give them
+        self.defaults = dict(temperature=1.0, top_k=40, top_p=None, repetition_penalty=1.0, do_sample=True)
+        self.defaults.update(defaults or {})
+        self.metrics = ServerMetrics()
+        self.queue = None
+        # the model (and its kv cache) is only ever used from this thread
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="generate")
+        # and the tokenizer and token cache only from this one, they are not
+        # thread safe
+        self.midi_executor = ThreadPoolExecutor(1, thread_name_prefix="midi")
+
+    # -- batching
+
+    async def submit(self, prompt, steps: int, sampler: TokenSampler):
+        """queue one prompt, returns its completion (prompt + steps new ids)"""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put(Pending(prompt, steps, sampler, future))
+        return await future
+
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            started = time.perf_counter()
+            try:
+                completions = await loop.run_in_executor(self.executor, self.run_batch, batch)
+            except Exception as e:
+                logger.exception("batch of %d failed", len(batch))
+                for p in batch:
+                    if not p.future.done():
+                        p.future.set_exception(e)
+                continue
+            self.metrics.batches += 1
+            self.metrics.batch_sizes.append(len(batch))
+            self.metrics.batch_ms.append(1000 * (time.perf_counter() - started))
+            for p, completion in zip(batch, completions):
+                self.metrics.queue_ms.append(1000 * (started - p.arrived))
+                self.metrics.tokens += p.steps
+                if not p.future.done():
+                    p.future.set_result(completion)
+
+    def run_batch(self, batch):
+        # one generate_batch for all, each row leaves the batch after its own
+        # number of steps
+        completions = self.model.generate_batch(
+            [p.prompt for p in batch], [p.steps for p in batch], sampler=[p.sampler for p in batch])
+        return [c.cpu() for c in completions]
+
+    # -- midi
+
+    def encode(self, midi: bytes):
+        if self.token_cache is not None:
+            return self.token_cache.ids_from_bytes(midi)
+        from symusic import Score
+
+        return np.asarray(self.tokenizer.encode(Score.from_midi(midi))[0].ids)
+
+    def decode(self, ids) -> bytes:
+        ids = [int(i) for i in ids if i != 0]
+        score = self.tokenizer.decode([ids])
+        for track in score.tracks:
+            track.is_drum = True
+        return score.dumps_midi()
+
+    # -- http
+
+    def _sampler(self, query) -> TokenSampler:
+        args = dict(self.defaults)
+        for name, cast in (("temperature", float), ("top_k", int), ("top_p", float),
+                           ("repetition_penalty", float), ("seed", int)):
+            if name in query:
+                args[name] = cast(query[name])
+        if "do_sample" in query:
+            args["do_sample"] = query["do_sample"].lower() in ("1", "true", "yes")
+        return TokenSampler(**args)
+
+    async def generate(self, query, headers, body):
+        loop = asyncio.get_running_loop()
+        as_json = headers.get("content-type", "").startswith("application/json")
+        try:
+            steps = int(query.get("steps", self.default_steps))
+            sampler = self._sampler(query)
+            if as_json:
+                prompt = json.loads(body)["tokens"]
+            elif self.tokenizer is None and self.token_cache is None:
+                raise HTTPError(400, "no tokenizer loaded, send application/json tokens")
+            else:
+                prompt = await loop.run_in_executor(self.midi_executor, self.encode, body)
+            prompt = torch.as_tensor(prompt, dtype=torch.long).view(-1)
+        except HTTPError:
+            raise
+        except Exception as e:
+            raise HTTPError(400, f"bad request: {type(e).__name__}: {e}")
+        if not 0 < steps <= self.max_steps:
+            raise HTTPError(400, f"steps must be in 1..{self.max_steps}")
+        if len(prompt) == 0:
+            raise HTTPError(400, "empty prompt")
+        if int(prompt.min()) < 0 or int(prompt.max()) >= self.model.transformer.wte.num_embeddings:
+            raise HTTPError(400, "token id out of range")
+
+        completion = await self.submit(prompt, steps, sampler)
+        if as_json:
+            return "application/json", json.dumps({"tokens": completion.tolist()}).encode()
+        return "audio/midi", await loop.run_in_executor(self.midi_executor, self.decode, completion.tolist())
+
+    async def route(self, method, path, query, headers, body):
+        if method == "POST" and path == "/generate":
+            return await self.generate(query, headers, body)
+        if method == "GET" and path == "/metrics":
+            return "application/json", json.dumps(self.metrics.snapshot()).encode()
+        if method == "GET" and path == "/health":
+            health = dict(
+                ok=True,
+                vocab_size=self.model.transformer.wte.num_embeddings,
+                block_size=self.model.block_size,
+            )
+            return "application/json", json.dumps(health).encode()
+        raise HTTPError(404, f"no route {method} {path}")
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    message = await read_message(reader, self.max_body)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except HTTPError as e:
+                    message, error = None, e
+                else:
+                    error = None
+                    if message is None:
+                        break
+                started = time.perf_counter()
+                keep_alive = False
+                try:
+                    if error is not None:
+                        raise error
+                    start, headers, body = message
+                    method, target, version = start.split(" ", 2)
+                    keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                    url = urlsplit(target)
+                    query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                    content_type, payload = await self.route(method, url.path, query, headers, body)
+                    status = 200
+                except HTTPError as e:
+                    status, content_type = e.status, "application/json"
+                    payload = json.dumps({"error": str(e)}).encode()
+                except Exception as e:
+                    logger.exception("request failed")
+                    status, content_type = 500, "application/json"
+                    payload = json.dumps({"error": f"{type(e).__name__}: {e}"}).encode()
+
+                if message is not None and message[0].startswith("POST"):
+                    self.metrics.requests += 1
+                    self.metrics.errors += status != 200
+                    if status == 200:
+                        self.metrics.latency_ms.append(1000 * (time.perf_counter() - started))
+                writer.write(
+                    f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(payload)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1")
+                    + payload
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8000, ready=None):
+        """run until cancelled, ready (an asyncio.Event) is set once listening"""
+        self.queue = asyncio.Queue()
+        batcher = asyncio.create_task(self.batcher())
+        server = await asyncio.start_server(self.handle, host, port)
+        logger.info("listening on %s", ", ".join(str(s.getsockname()) for s in server.sockets))
+        if ready is not None:
+            ready.set()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            self.executor.shutdown(wait=False)
+            self.midi_executor.shutdown(wait=False)
+
+
+def load_model(checkpoint: str, quantize: str = None, model_type: str = None):
+    """
+    a GPT with the weights in checkpoint, optionally int8. Its shape is
+    CONFIG's, or the preset model_type's (e.g. "gpt-nano").
+    """
+    from gpt_mini.vocab import load_checkpoint
+
+    model, _ = load_checkpoint(checkpoint, model_type)
+    if quantize is not None:
+        from gpt_mini.quantize import quantize_model
+
+        model = quantize_model(model, quantize)
+    return model
+
+
+def get_default_config():
+    C = CN()
+    C.host = "127.0.0.1"
+    C.port = 8000
+    # trained weights: a state dict, or a Trainer checkpoint / best.pt
+    C.checkpoint = "./checkpoints/best.pt"
+    # None for JSON token requests only
+    C.tokenizer = CONFIG["tokenizer"]["model"]
+    # None, or "dynamic" / "weight_only" (see quantize.py)
+    C.quantize = None
+    # a batch starts at most max_wait_ms after its first request
+    C.max_batch = 8
+    C.max_wait_ms = 10.0
+    C.steps = 64
+    C.max_steps = 1024
+    C.temperature = 1.0
+    C.top_k = 40
+    C.threads = None
+    return C
+
+
+if __name__ == "__main__":
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+    config = get_default_config()
+    config.merge_from_args(sys.argv[1:])
+    if config.threads is not None:
+        torch.set_num_threads(config.threads)
+
+    token_cache = None
+    if config.tokenizer is not None:
+        from gpt_mini.token_cache import TokenCache
+
+        # prompts arrive as bytes, the cache stays in memory
+        token_cache = TokenCache(config.tokenizer, cache_dir=None)
+    server = GenerationServer(
+        load_model(config.checkpoint, config.quantize),
+        tokenizer=None if token_cache is None else token_cache.tokenizer,
+        token_cache=token_cache,
+        max_batch=config.max_batch,
+        max_wait_ms=config.max_wait_ms,
+        default_steps=config.steps,
+        max_steps=config.max_steps,
+        defaults=dict(temperature=config.temperature, top_k=config.top_k),
+    )
+    try:
+        asyncio.run(server.serve(config.host, config.port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,221 @@
+"""
+Speculative decoding: a small draft GPT (e.g. the gpt-nano preset, same
+vocabulary) proposes k tokens one at a time, then the target GPT scores all
+of them in a single forward pass. Draft token i is kept with probability
+min(1, p_i / q_i), p and q being the target's and the draft's distribution
+for it. At the first rejection a token is drawn from max(0, p - q)
+instead, and when all k are kept the target adds one of its own. The
+output has exactly the target's distribution (greedy decoding gives the
+target's greedy tokens), only the number of target forwards per token
+goes down, the more so the more often the draft agrees with the target.
+
+    model.generate(idx, 256, do_sample=True, top_k=40, draft=draft_model)
+
+Benchmark against plain generate (kv cached) for a few k:
+
+    python -m gpt_mini.speculative --target=checkpoints/best.pt \\
+        --draft=checkpoints/draft.pt --draft_type=gpt-nano --k=2,4,8
+"""
+
+import time
+import statistics
+
+import torch
+
+from gpt_mini.config import CONFIG
+from gpt_mini.decoding import TokenSampler
+from gpt_mini.utils import CfgNode as CN
+
+
+class SpeculativeDecoder:
+    """
+    Decodes one sequence at a time (batch size 1). Both models keep a kv
+    cache; after each round it is rolled back to the accepted tokens. Once
+    a round would no longer fit in block_size the rest is plain generate().
+    """
+
+    def __init__(self, target, draft, k: int = 4):
+        assert k >= 1
+        # each needs its own kv cache, for self-drafting pass a copy
+        assert draft is not target, "the draft must be a separate model"
+        assert (
+            target.transformer.wte.num_embeddings == draft.transformer.wte.num_embeddings
+        ), "draft and target need the same vocabulary"
+        self.target = target
+        self.draft = draft
+        self.k = k
+        self.rounds = 0
+        self.proposed = 0
+        self.accepted = 0
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.accepted / max(self.proposed, 1)
+
+    def _draw(self, probs, sampler):
+        return torch.multinomial(probs, num_samples=1, generator=sampler.generator(probs.device))
+
+    @torch.no_grad()
+    def generate(self, idx, max_new_tokens, sampler: TokenSampler = None):
+        """idx is (1, t), returns (1, t + max_new_tokens) like GPT.generate"""
+        assert idx.size(0) == 1, "speculative decoding works on one sequence at a time"
+        sampler = sampler or TokenSampler()
+        target, draft = self.target, self.draft
+        block_size = min(target.block_size, draft.block_size)
+        end = idx.size(1) + max_new_tokens
+        target.set_kv_cache(True)
+        draft.set_kv_cache(True)
+        try:
+            while idx.size(1) < end:
+                k = min(self.k, end - idx.size(1))
+                # the target sees the last accepted token and the k proposals
+                if idx.size(1) + k > block_size:
+                    break
+                idx = self._round(idx, k, sampler)
+        finally:
+            target.set_kv_cache(False)
+            draft.set_kv_cache(False)
+        if idx.size(1) < end:
+            idx = target.generate(idx, end - idx.size(1), sampler=sampler)
+        return idx[:, :end]
+
+    def _round(self, idx, k, sampler):
+        """one draft / verify round, returns idx with 1 to k + 1 tokens more"""
+        t = idx.size(1)
+        # each cache holds all of idx but its last token, or less
+        seq = idx
+        q = []
+        for _ in range(k):
+            logits, _ = self.draft(seq[:, self.draft.kv_cache_length() :])
+            q.append(sampler.probs(logits[:, -1, :], seq)[0])
+            seq = torch.cat((seq, self._draw(q[-1][None], sampler)), dim=1)
+
+        logits, _ = self.target(seq[:, self.target.kv_cache_length() :])
+        # the target's predictions for positions t .. t + k
+        logits = logits[0, -(k + 1) :]
+        if sampler.repetition_penalty == 1.0:
+            p = sampler.probs(logits)
+        else:
+            # the penalty depends on the context, which grows by a token per position
+            p = torch.cat([sampler.probs(logits[i : i + 1], seq[:, : t + i]) for i in range(k + 1)])
+        q = torch.stack(q)
+
+        # keep draft token i with probability min(1, p_i / q_i), up to the first rejection
+        proposed = seq[0, t:]
+        rows = torch.arange(k, device=seq.device)
+        ratio = p[rows, proposed] / q[rows, proposed]
+        uniform = torch.rand(k, generator=sampler.generator(seq.device), device=seq.device)
+        rejected = (uniform >= ratio).nonzero()
+        n = int(rejected[0, 0]) if len(rejected) else k
+        if n < k:
+            residual = (p[n] - q[n]).clamp(min=0)
+            # p == q (nothing left over) can only reject with probability 0
+            p_next = residual / residual.sum() if residual.sum() > 0 else p[n]
+        else:
+            p_next = p[k]
+        new = self._draw(p_next[None], sampler)
+        self.rounds += 1
+        self.proposed += k
+        self.accepted += n
+
+        idx = torch.cat((seq[:, : t + n], new), dim=1)
+        # positions past the accepted tokens were computed for rejected ones
+        self.target.truncate_kv_cache(t + n)
+        self.draft.truncate_kv_cache(t + n)
+        return idx
+
+
+def _median_time(fn, repeats):
+    fn()  # warmup
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return statistics.median(times)
+
+
+def benchmark(target, draft, prompt, new_tokens, ks, sampler_args, repeats=3) -> list:
+    """ms per token of target.generate and of speculative decoding for every k"""
+    target.eval()
+    draft.eval()
+
+    def plain():
+        target.generate(prompt, new_tokens, sampler=TokenSampler(**sampler_args))
+
+    base = 1000 * _median_time(plain, repeats) / new_tokens
+    results = [dict(mode="generate", k=0, ms_per_token=base, speedup=1.0)]
+    for k in ks:
+        decoder = SpeculativeDecoder(target, draft, k)
+
+        def speculative():
+            decoder.generate(prompt, new_tokens, TokenSampler(**sampler_args))
+
+        ms = 1000 * _median_time(speculative, repeats) / new_tokens
+        results.append(dict(
+            mode="speculative", k=k, ms_per_token=ms, speedup=base / ms,
+            acceptance_rate=decoder.acceptance_rate,
+            tokens_per_round=(decoder.accepted + decoder.rounds) / max(decoder.rounds, 1),
+        ))
+    return results
+
+
+def get_default_config():
+    C = CN()
+    # trained weights (state dicts or Trainer checkpoints); None for a
+    # randomly initialised model, only good for timing
+    C.target = None
+    C.draft = None
+    # None: CONFIG's model shape
+    C.target_type = None
+    C.draft_type = "gpt-nano"
+    # tokens proposed per round, comma separated
+    C.k = "2,4,8"
+    # prompt from the pre-tokenized validation set (bpe.pretokenize), or random
+    C.data = CONFIG["preprocess"]["tokens_validation"]
+    C.prompt_length = 64
+    C.new_tokens = 128
+    C.do_sample = True
+    C.temperature = 1.0
+    C.top_k = 40
+    C.seed = 1337
+    C.repeats = 3
+    C.threads = None
+    return C
+
+
+if __name__ == "__main__":
+    import os
+    import sys
+    from gpt_mini.model import GPT
+    from gpt_mini.vocab import default_model_config, load_checkpoint
+
+    config = get_default_config()
+    config.merge_from_args(sys.argv[1:])
+    if config.threads is not None:
+        torch.set_num_threads(config.threads)
+    torch.manual_seed(config.seed)
+
+    def model(checkpoint, model_type):
+        if checkpoint is not None:
+            return load_checkpoint(checkpoint, model_type)[0]
+        return GPT(default_model_config(model_type)).eval()
+
+    target = model(config.target, config.target_type)
+    draft = model(config.draft, config.draft_type)
+    vocab_size = target.transformer.wte.num_embeddings
+    prompt = torch.randint(0, vocab_size, (1, config.prompt_length))
+    if config.data is not None and os.path.exists(f"{config.data}.index.npz"):
+        from gpt_mini.bpe import MemmapMidiDataset
+
+        prompt = MemmapMidiDataset(config.data, config.prompt_length + 1)[0][0].unsqueeze(0)
+
+    sampler_args = dict(
+        temperature=config.temperature, top_k=config.top_k, do_sample=config.do_sample, seed=config.seed)
+    # --k=2,4 arrives as a tuple, --k=4 as an int
+    ks = [int(k) for k in (config.k if isinstance(config.k, (list, tuple)) else str(config.k).split(","))]
+    for r in benchmark(target, draft, prompt, config.new_tokens, ks, sampler_args, config.repeats):
+        line = f"{r['mode']:>11} k={r['k']}: {r['ms_per_token']:7.2f} ms/token {r['speedup']:5.2f}x"
+        if r["mode"] == "speculative":
+            line += f"  acceptance {r['acceptance_rate']:.2f}, {r['tokens_per_round']:.2f} tokens/round"
+        print(line)
@@ -0,0 +1,168 @@
+"""
+A cache in front of the tokenizer's encode(), so the same midi file is only
+parsed and tokenized once: MidiDataset over several epochs, pretokenize
+runs and prompts at inference all go through TokenCache.ids().
+
+Entries are keyed by the sha1 of the file's contents and stored as .npy
+files under {cache_dir}/{tokenizer version}/, the version being the hash
+of the tokenizer pickle. Retraining the tokenizer gives a new version
+directory, so stale tokens are never read; the old versions stay on disk
+until pruned. A small in-memory LRU sits in front of the disk.
+
+    cache = TokenCache(CONFIG["tokenizer"]["model"])
+    ids = cache.ids("./input/1.mid")  # same as tokenizer.encode(path)[0].ids
+
+Deleting the entries of every other tokenizer version:
+
+    python -m gpt_mini.token_cache --tokenizer=./tokenizer.pickle
+"""
+
+import os
+import shutil
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+from gpt_mini.config import CONFIG
+from gpt_mini.utils import CfgNode as CN
+
+
+def _sha1_file(path: str) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class TokenCache:
+    """
+    cache_dir=None keeps the cache in memory only. capacity is the number
+    of songs the LRU holds. The tokenizer itself is only unpickled on the
+    first miss, so a fully cached dataset never loads it.
+    """
+
+    def __init__(self, tokenizer_path: str, cache_dir: str = CONFIG["tokenizer"]["cache"], capacity: int = 1024):
+        self.tokenizer_path = tokenizer_path
+        self.version = _sha1_file(tokenizer_path)[:16]
+        self.cache_dir = cache_dir
+        self.dir = None if cache_dir is None else os.path.join(cache_dir, self.version)
+        self.capacity = capacity
+        self.hits = self.misses = 0
+        self._tokenizer = None
+        self._lru = OrderedDict()
+        # path -> (size, mtime, hash), so unchanged files are not hashed again
+        self._hashes = {}
+        if self.dir is not None:
+            os.makedirs(self.dir, exist_ok=True)
+
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            from gpt_mini.bpe import load_tokenizer
+
+            self._tokenizer = load_tokenizer(self.tokenizer_path)
+        return self._tokenizer
+
+    def __getstate__(self):
+        # DataLoader workers get their own (empty) LRU and load the tokenizer lazily
+        state = self.__dict__.copy()
+        state.update(_tokenizer=None, _lru=OrderedDict(), _hashes={})
+        return state
+
+    def prune(self) -> list:
+        """
+        delete the entries of every other tokenizer version, returns the
+        directories removed. Not safe while a cache for another tokenizer is
+        in use.
+        """
+        removed = []
+        if self.cache_dir is None or not os.path.isdir(self.cache_dir):
+            return removed
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name != self.version and os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+                removed.append(path)
+        return removed
+
+    def _hash(self, path: str) -> str:
+        st = os.stat(path)
+        cached = self._hashes.get(path)
+        if cached is not None and cached[:2] == (st.st_size, st.st_mtime_ns):
+            return cached[2]
+        digest = _sha1_file(path)
+        self._hashes[path] = (st.st_size, st.st_mtime_ns, digest)
+        return digest
+
+    def _entry(self, digest: str) -> str:
+        return os.path.join(self.dir, digest[:2], f"{digest}.npy")
+
+    def _get(self, digest: str):
+        ids = self._lru.get(digest)
+        if ids is not None:
+            self._lru.move_to_end(digest)
+            return ids
+        if self.dir is not None:
+            try:
+                ids = np.load(self._entry(digest))
+            except (OSError, ValueError):
+                return None
+            self._put(digest, ids, write=False)
+        return ids
+
+    def _put(self, digest: str, ids: np.ndarray, write=True):
+        ids.setflags(write=False)
+        self._lru[digest] = ids
+        self._lru.move_to_end(digest)
+        while len(self._lru) > self.capacity:
+            self._lru.popitem(last=False)
+        if write and self.dir is not None:
+            entry = self._entry(digest)
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            tmp = f"{entry}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                np.save(f, ids)
+            os.replace(tmp, entry)
+
+    def _lookup(self, digest: str, encode) -> np.ndarray:
+        ids = self._get(digest)
+        if ids is not None:
+            self.hits += 1
+            return ids
+        self.misses += 1
+        ids = np.asarray(encode()[0].ids, dtype=np.int32)
+        self._put(digest, ids)
+        return ids
+
+    def ids(self, path: str) -> np.ndarray:
+        """the token ids of the midi file at path (read-only)"""
+        return self._lookup(self._hash(path), lambda: self.tokenizer.encode(path))
+
+    def ids_from_bytes(self, data: bytes) -> np.ndarray:
+        """the token ids of a midi file already in memory (read-only)"""
+
+        def encode():
+            from symusic import Score
+
+            return self.tokenizer.encode(Score.from_midi(data))
+
+        return self._lookup(hashlib.sha1(data).hexdigest(), encode)
+
+
+def get_default_config():
+    C = CN()
+    C.tokenizer = CONFIG["tokenizer"]["model"]
+    C.cache = CONFIG["tokenizer"]["cache"]
+    return C
+
+
+if __name__ == "__main__":
+    import sys
+
+    config = get_default_config()
+    config.merge_from_args(sys.argv[1:])
+    cache = TokenCache(config.tokenizer, config.cache)
+    removed = cache.prune()
+    print(f"tokenizer version {cache.version}, removed {len(removed)} stale version(s) from {config.cache}")
@@ -4,14 +4,23 @@ network, so nothing in this file really has anything to do with GPT
 specifically.
 """
 
+import copy
 import time
 import math
+import threading
 from typing import Tuple
+from contextlib import nullcontext
 from collections import defaultdict
 
 import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.utils.data.dataloader import DataLoader
 from gpt_mini.utils import CfgNode as CN
+from gpt_mini.metrics import Metrics
+from gpt_mini.samplers import ResumableRandomSampler, BucketBatchSampler, trim_collate
+from gpt_mini.checkpoint import CheckpointManager, to_cpu, get_rng_state, set_rng_state
+from gpt_mini.profiling import TrainingProfiler
 
 
 class Trainer:
@@ -30,6 +39,50 @@ class Trainer:
         C.betas = (0.9, 0.95)
         C.weight_decay = 0.1  # only applied on matmul weights
         C.grad_norm_clip = 1.0
+        # compute dtype: "float32", or "bfloat16" to run forward under autocast
+        # (weights, gradients and optimizer state stay in float32)
+        C.dtype = "float32"
+        # run the forward/backward through torch.compile(model)
+        C.compile = False
+        # samples per forward/backward pass. batch_size stays the effective
+        # batch size per optimizer step, reached by accumulating gradients
+        # over batch_size // micro_batch micro batches. None: no accumulation
+        C.micro_batch = None
+        # validate on at most this many batches (None: the whole set)
+        C.val_max_batches = None
+        # if the validation set has lengths(), batch songs of similar length
+        # together and trim each batch to its longest song
+        C.val_bucketing = True
+        # validate in a background thread on a snapshot of the weights instead
+        # of pausing training; results arrive through on_validation_end
+        C.async_validation = False
+        # training loss/accuracy/perplexity are read back from the device
+        # every metrics_interval iterations (and appended to metrics_log, a
+        # JSONL file, if set)
+        C.metrics_interval = 100
+        C.metrics_log = None
+        # seed of the training data order
+        C.seed = 1337
+        # checkpoints (model, optimizer, rng and data position) are written to
+        # checkpoint_dir every checkpoint_interval iterations, keeping the
+        # last keep_last of them plus the best by validation loss
+        C.checkpoint_dir = None
+        C.checkpoint_interval = 1000
+        C.keep_last = 3
+        # continue from the latest checkpoint in checkpoint_dir, if any
+        C.resume = True
+        # profiling: every profile_interval iterations report samples/tokens
+        # per second, DataLoader wait vs compute time, peak memory and the
+        # forward/backward time of the modules named in profile_modules
+        # through on_profile (as trainer.profile_report)
+        C.profile = False
+        C.profile_interval = 100
+        C.profile_modules = ("Block", "CausalSelfAttention", "MLP")
+        # write a torch.profiler trace of profile_trace_steps iterations from
+        # profile_trace_start into profile_trace_dir
+        C.profile_trace_dir = None
+        C.profile_trace_start = 10
+        C.profile_trace_steps = 5
         return C
 
     def __init__(self, config, model, train_dataset, val_dataset):
@@ -40,18 +93,93 @@ class Trainer:
         self.val_dataset = val_dataset
         self.callbacks = defaultdict(list)
 
+        # data parallel training, when the process group has been set up
+        # before creating the Trainer (see gpt_mini/distributed.py). Each
+        # process trains on its own shard with batch_size samples per step;
+        # only rank 0 validates, checkpoints and runs callbacks.
+        self.distributed = dist.is_available() and dist.is_initialized()
+        self.rank = dist.get_rank() if self.distributed else 0
+        self.world_size = dist.get_world_size() if self.distributed else 1
+        self.is_main = self.rank == 0
+
         # determine the device we'll train on
         if config.device == "auto":
             self.device = "cuda" if torch.cuda.is_available() else "cpu"
         else:
             self.device = config.device
         self.model = self.model.to(self.device)
-        print("running on device", self.device)
+        self.log("running on device", self.device)
+
+        assert config.dtype in ("float32", "bfloat16")
+        self.autocast_dtype = torch.bfloat16 if config.dtype == "bfloat16" else None
+        # self.model stays the plain module so its state_dict is unaffected
+        # by DDP and compilation, forward/backward goes through self.train_model
+        self.ddp_model = None
+        train_model = self.model
+        if self.distributed:
+            device_ids = [self.device] if torch.device(self.device).type == "cuda" else None
+            self.ddp_model = train_model = DDP(self.model, device_ids=device_ids)
+        self.train_model = torch.compile(train_model) if config.compile else train_model
+
+        self.micro_batch = config.micro_batch or config.batch_size
+        assert (
+            config.batch_size % self.micro_batch == 0
+        ), "batch_size must be a multiple of micro_batch"
+        self.grad_accum_steps = config.batch_size // self.micro_batch
+        self.mode = "%s%s, %d x %d micro batches" % (
+            config.dtype,
+            " compiled" if config.compile else "",
+            self.grad_accum_steps,
+            self.micro_batch,
+        )
+        if self.distributed:
+            self.mode += ", %d processes" % self.world_size
+        self.log("training mode:", self.mode)
 
         # variables that will be assigned to trainer class later for logging and etc
         self.iter_num = 0
         self.iter_time = 0.0
         self.iter_dt = 0.0
+        # latest validation results, and the iteration they were taken at
+        self.val_loss = None
+        self.val_pp = None
+        self.val_acc = None
+        self.val_iter = None
+        self._val_thread = None
+        self._val_result = None
+        # training metrics since the last flush, see flush_metrics
+        self.metrics = Metrics(config.metrics_log if self.is_main else None)
+        self.train_metrics = None
+
+        # position in the training data: epochs started and micro batches
+        # consumed in the current one
+        self.epoch = 0
+        self.epoch_batches = 0
+        self.best_val_loss = None
+        self._val_model = None
+        self.checkpoints = None
+        if config.checkpoint_dir is not None:
+            self.checkpoints = CheckpointManager(config.checkpoint_dir, config.keep_last)
+
+        # see gpt_mini/profiling.py; the per module hooks are left out for a
+        # compiled model, they would break its graph
+        self.profiler = None
+        self.profile_report = None
+        if config.profile or config.profile_trace_dir is not None:
+            self.profiler = TrainingProfiler(
+                self.model,
+                device=self.device,
+                module_names=config.profile_modules if config.profile and not config.compile else None,
+                trace_dir=config.profile_trace_dir,
+                trace_start=config.profile_trace_start,
+                trace_steps=config.profile_trace_steps,
+            )
+
+    def autocast(self):
+        if self.autocast_dtype is None:
+            return nullcontext()
+        return torch.autocast(
+            device_type=torch.device(self.device).type, dtype=self.autocast_dtype)
 
     def add_callback(self, onevent: str, callback):
         self.callbacks[onevent].append(callback)
@@ -60,124 +188,325 @@ class Trainer:
         self.callbacks[onevent] = [callback]
 
     def trigger_callbacks(self, onevent: str):
+        if not self.is_main:
+            return
         for callback in self.callbacks.get(onevent, []):
             callback(self)
 
+    def log(self, *args):
+        if self.is_main:
+            print(*args)
+
     def perplexity(self, avg_loss) -> float:
         return math.exp(avg_loss)
 
     def calculate_accuracy(self, logits, y):
         # Generate predictions by taking the argmax of the logits
         predictions = torch.argmax(logits, dim=-1)
-        # Compare predictions to labels and calculate accuracy
-        correct_predictions = (predictions == y).sum().item()
-        total_predictions = y.size(0)
-        accuracy = correct_predictions / total_predictions
+        # Compare predictions to labels (ignoring padding) and calculate accuracy
+        valid = y != -1
+        correct_predictions = ((predictions == y) & valid).sum().item()
+        total_predictions = valid.sum().item()
+        accuracy = correct_predictions / max(total_predictions, 1)
         return accuracy
 
-    def validate(self, val_loader) -> Tuple[float, float, float]:
-        model = self.model
+    def flush_metrics(self, reduce: bool = False) -> dict:
+        """
+        Read back the training metrics accumulated since the last flush,
+        publish them as batch_pp / batch_accuracy / train_metrics and fire
+        on_metrics. Callbacks may call this whenever they want fresh numbers
+        (in distributed mode those are rank 0's own, only the scheduled
+        flushes reduce over all processes).
+        """
+        record = self.metrics.flush(reduce=reduce, iter=self.iter_num)
+        if record is not None:
+            self.train_metrics = record
+            self.batch_pp = record["perplexity"]
+            self.batch_accuracy = record["accuracy"]
+            self.trigger_callbacks("on_metrics")
+        return record
+
+    def validate(self, val_loader, model=None) -> Tuple[float, float, float]:
+        """
+        Evaluate model (default: the model being trained) on at most
+        config.val_max_batches batches of val_loader. Losses and accuracies
+        are summed on the device and only read back once at the end.
+
+        Returns the mean loss per target token, its perplexity and the token
+        level accuracy.
+        """
+        model = self.model if model is None else model
         model.eval()  # Set the model to evaluation mode
 
-        val_losses = []
-        val_accuracies = []
-        num_tokens = 0
+        metrics = Metrics()
+        num_batches = 0
 
         with torch.no_grad():
             for batch in val_loader:
+                if self.config.val_max_batches is not None and num_batches >= self.config.val_max_batches:
+                    break
                 batch = [t.to(self.device) for t in batch]
                 x, y = batch
-                logits, loss = model(x, y)
-                val_losses.append(loss.item())
-                num_tokens += x.size(0)
-
-                # Calculate accuracy for the batch
-                batch_accuracy = self.calculate_accuracy(logits, y)
-                val_accuracies.append(batch_accuracy)
+                with self.autocast():
+                    logits, loss = model(x, y)
+                metrics.update(loss, logits, y)
+                num_batches += 1
 
         # Calculate the average validation loss, perplexity, and accuracy
-        avg_val_loss = sum(val_losses) / num_tokens
-        val_pp = self.perplexity(avg_val_loss)
-        avg_val_accuracy = sum(val_accuracies) / len(val_accuracies)
+        record = metrics.flush()
+        avg_val_loss = record["loss"]
+        val_pp = record["perplexity"]
+        avg_val_accuracy = record["accuracy"]
 
         model.train()  # Set the model back to training mode
         return avg_val_loss, val_pp, avg_val_accuracy
 
+    def start_validation(self, val_loader):
+        """
+        Validate according to config.async_validation: either right away, or
+        in a background thread on a copy of the current weights. Returns False
+        if an earlier background validation is still running (this one is
+        skipped then).
+        """
+        if not self.config.async_validation:
+            self._val_model = self.model
+            self._val_result = (self.iter_num, self.validate(val_loader))
+            self.finish_validation()
+            return True
+        if self._val_thread is not None and self._val_thread.is_alive():
+            return False
+
+        snapshot = copy.deepcopy(self.model)
+        self._val_model = snapshot
+        iter_num = self.iter_num
+
+        def work():
+            try:
+                self._val_result = (iter_num, self.validate(val_loader, snapshot))
+            except Exception as e:
+                self._val_result = e
+
+        self._val_thread = threading.Thread(target=work, daemon=True)
+        self._val_thread.start()
+        return True
+
+    def finish_validation(self, wait=False):
+        """publish a finished validation result and fire on_validation_end"""
+        if self._val_thread is not None:
+            if wait:
+                self._val_thread.join()
+            if self._val_thread.is_alive():
+                return
+            self._val_thread = None
+        result, self._val_result = self._val_result, None
+        if result is None:
+            return
+        if isinstance(result, Exception):
+            raise result
+        self.val_iter, (self.val_loss, self.val_pp, self.val_acc) = result
+        if self.best_val_loss is None or self.val_loss < self.best_val_loss:
+            self.best_val_loss = self.val_loss
+            if self.checkpoints is not None:
+                # the weights that were validated, which in async mode are
+                # a few iterations behind the model being trained
+                self.checkpoints.save_best(to_cpu({
+                    "model": self._val_model.state_dict(),
+                    "iter_num": self.val_iter,
+                    "val_loss": self.val_loss,
+                    "config": self.config.to_dict(),
+                }))
+        self._val_model = None
+        self.trigger_callbacks("on_validation_end")
+
+    def state_dict(self) -> dict:
+        """everything needed to continue training exactly where it is now"""
+        return {
+            "model": self.model.state_dict(),
+            "optimizer": self.optimizer.state_dict(),
+            "iter_num": self.iter_num,
+            "epoch": self.epoch,
+            "epoch_batches": self.epoch_batches,
+            "best_val_loss": self.best_val_loss,
+            "rng": get_rng_state(),
+            "config": self.config.to_dict(),
+        }
+
+    def load_state_dict(self, state: dict):
+        self.model.load_state_dict(state["model"])
+        self.optimizer.load_state_dict(state["optimizer"])
+        self.iter_num = state["iter_num"]
+        self.epoch = state["epoch"]
+        self.epoch_batches = state["epoch_batches"]
+        self.best_val_loss = state["best_val_loss"]
+        rng = state["rng"]
+        if isinstance(rng, list):
+            # one per rank, see save_checkpoint
+            rng = rng[self.rank] if len(rng) == self.world_size else rng[0]
+        set_rng_state(rng)
+
+    def save_checkpoint(self):
+        """copy the training state and write it out in the background"""
+        state = self.state_dict()
+        if self.distributed:
+            # every rank has its own dropout stream, rank 0 stores them all
+            rngs = [None] * self.world_size
+            dist.all_gather_object(rngs, state["rng"])
+            state["rng"] = rngs
+        if self.is_main:
+            self.checkpoints.save(to_cpu(state), self.iter_num)
+
     def run(self):
         model, config = self.model, self.config
 
         # setup the optimizer
         self.optimizer = model.configure_optimizers(config)
 
-        # setup the dataloader
+        # setup the dataloader. The sampler and the loaders get their own
+        # generators so that the global RNG (dropout) only advances with the
+        # training steps, which keeps resumed runs bit exact.
+        sampler = ResumableRandomSampler(
+            self.train_dataset,
+            num_samples=self.config.max_sample_size,
+            seed=config.seed,
+            rank=self.rank,
+            world_size=self.world_size,
+        )
         train_loader = DataLoader(
             self.train_dataset,
-            sampler=torch.utils.data.RandomSampler(
-                self.train_dataset,
-                replacement=True,
-                num_samples=self.config.max_sample_size
-            ),
+            sampler=sampler,
             shuffle=False,
             pin_memory=True,
-            batch_size=config.batch_size,
+            batch_size=self.micro_batch,
             num_workers=config.num_workers,
+            generator=torch.Generator().manual_seed(config.seed),
         )
 
-        val_loader = DataLoader(
-            self.val_dataset,
-            shuffle=False,
-            pin_memory=True,
-            batch_size=config.batch_size,
-            num_workers=config.num_workers,
-        )
+        if config.val_bucketing and hasattr(self.val_dataset, "lengths"):
+            # shuffled batch order so that val_max_batches still sees all lengths
+            val_loader = DataLoader(
+                self.val_dataset,
+                batch_sampler=BucketBatchSampler(
+                    self.val_dataset.lengths(), config.batch_size, shuffle=True, seed=config.seed),
+                collate_fn=trim_collate,
+                pin_memory=True,
+                num_workers=config.num_workers,
+                generator=torch.Generator().manual_seed(config.seed),
+            )
+        else:
+            val_loader = DataLoader(
+                self.val_dataset,
+                shuffle=False,
+                pin_memory=True,
+                batch_size=config.batch_size,
+                num_workers=config.num_workers,
+                generator=torch.Generator().manual_seed(config.seed),
+            )
 
         model.train()
         self.iter_num = 0
+        self.epoch = 0
+        self.epoch_batches = 0
+        if config.resume and self.checkpoints is not None and self.checkpoints.latest():
+            path = self.checkpoints.latest()
+            # on the cpu: the rng states must stay cpu tensors, the model and
+            # optimizer move their own state to the parameters' device
+            self.load_state_dict(self.checkpoints.load(path, map_location="cpu"))
+            self.log(f"resumed from {path} at iteration {self.iter_num}")
         self.iter_time = time.time()
+        sampler.set_epoch(self.epoch, start=self.epoch_batches * self.micro_batch)
         data_iter = iter(train_loader)
         # keep track of the number of iterations between validations
         validation_interval = config.validation_interval
+        iter_dts = []
 
-        while True:
-            # fetch the next batch (x, y) and re-init iterator if needed
-            try:
-                batch = next(data_iter)
-            except StopIteration:
-                data_iter = iter(train_loader)
-                batch = next(data_iter)
-            batch = [t.to(self.device) for t in batch]
-            x, y = batch
-
-            # forward the model
-            logits, self.loss = model(x, y)
-
-            # Calculate perplexity for this batch
-            avg_loss = self.loss.item() / x.size(0)  # Average loss per token
-            batch_pp = self.perplexity(avg_loss)
-            self.batch_pp = batch_pp
-            # Calculate accuracy for the batch
-            batch_accuracy = self.calculate_accuracy(logits, y)
-            self.batch_accuracy = batch_accuracy
-
-            # backprop and update the parameters
+        profiler = self.profiler
+        # both are no-ops without a profiler
+        phase = profiler.phase if profiler is not None else lambda name: nullcontext()
+        paused = profiler.paused if profiler is not None else nullcontext
+        while config.max_iters is None or self.iter_num < config.max_iters:
+            if profiler is not None:
+                profiler.step_begin(self.iter_num)
+                data_time, samples, tokens = 0.0, 0, 0
             model.zero_grad(set_to_none=True)
-            self.loss.backward()
+            losses = []
+            for micro_step in range(self.grad_accum_steps):
+                if profiler is not None:
+                    t0 = time.perf_counter()
+                # fetch the next batch (x, y) and re-init iterator if needed
+                try:
+                    batch = next(data_iter)
+                except StopIteration:
+                    self.epoch += 1
+                    self.epoch_batches = 0
+                    sampler.set_epoch(self.epoch)
+                    data_iter = iter(train_loader)
+                    batch = next(data_iter)
+                self.epoch_batches += 1
+                batch = [t.to(self.device) for t in batch]
+                x, y = batch
+                if profiler is not None:
+                    data_time += time.perf_counter() - t0
+                    samples += x.size(0)
+                    tokens += x.numel()
+
+                # gradients are only all-reduced across processes on the
+                # last micro batch of the step
+                sync = self.ddp_model is None or micro_step == self.grad_accum_steps - 1
+                with nullcontext() if sync else self.ddp_model.no_sync():
+                    # forward the model
+                    with phase("forward"), self.autocast():
+                        logits, loss = self.train_model(x, y)
+                    # backprop, gradients add up over the micro batches
+                    with phase("backward"):
+                        (loss / self.grad_accum_steps).backward()
+                losses.append(loss.detach())
+                # loss, accuracy and perplexity accumulate on the device
+                self.metrics.update(loss, logits, y)
+            self.loss = torch.stack(losses).mean()
+
+            # update the parameters
             torch.nn.utils.clip_grad_norm_(model.parameters(), config.grad_norm_clip)
             self.optimizer.step()
 
-            # Model validation
-            if self.iter_num % validation_interval == 0:
-                val_loss, val_pp, val_acc = self.validate(val_loader)
-                self.val_loss = val_loss
-                self.val_pp = val_pp
-                self.val_acc = val_acc
+            # Model validation, which does not count toward the step's time
+            with paused():
+                if self.is_main and self.iter_num % validation_interval == 0:
+                    self.start_validation(val_loader)
+                self.finish_validation()
+
+            if self.iter_num % config.metrics_interval == 0:
+                self.flush_metrics(reduce=self.distributed)
 
             self.trigger_callbacks("on_batch_end")
             self.iter_num += 1
             tnow = time.time()
             self.iter_dt = tnow - self.iter_time
             self.iter_time = tnow
+            iter_dts.append(self.iter_dt)
+
+            if profiler is not None:
+                profiler.step_end(self.iter_num - 1, data_time, samples, tokens)
+                if config.profile and self.iter_num % config.profile_interval == 0:
+                    self.profile_report = profiler.report(iter=self.iter_num)
+                    self.trigger_callbacks("on_profile")
 
             # termination conditions
-            if config.max_iters is not None and self.iter_num >= config.max_iters:
+            done = config.max_iters is not None and self.iter_num >= config.max_iters
+
+            if self.checkpoints is not None and (done or self.iter_num % config.checkpoint_interval == 0):
+                self.save_checkpoint()
+
+            if done:
                 break
+
+        self.finish_validation(wait=True)
+        if profiler is not None:
+            profiler.close(self.iter_num - 1)
+        if self.checkpoints is not None:
+            self.checkpoints.wait()
+
+        # the first iteration carries compilation/warmup, leave it out
+        steady = iter_dts[1:] or iter_dts
+        if steady:
+            self.mean_iter_dt = sum(steady) / len(steady)
+            self.log(f"{self.mode}: {self.mean_iter_dt * 1000:.2f}ms per iteration")
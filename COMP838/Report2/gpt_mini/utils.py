@@ -87,9 +87,10 @@ class CfgNode:
                 """
                 need some explanation here.
                 - if val is simply a string, literal_eval will throw a ValueError
+                  (or a SyntaxError for things like paths)
                 - if val represents a thing (like an 3, 3.14, [1,2,3], False, None, etc.) it will get created
                 """
-            except ValueError:
+            except (ValueError, SyntaxError):
                 pass
 
             # find the appropriate object to insert the attribute into
@@ -0,0 +1,121 @@
+"""
+Sizing the model's vocabulary to the tokenizer.
+
+The BPE tokenizer is trained towards CONFIG["tokenizer"]["vocab_size"]
+(50257, GPT-2's) but on drum tracks it stops far short of that. Every id it
+never produces still costs a row in transformer.wte and lm_head, and a column
+of logits per position. GPT's vocab_size should be len(tokenizer).
+
+Checkpoints trained with the oversized vocabulary can be cut down, as long
+as the tokenizer's ids are all below the new size:
+
+    python -m gpt_mini.vocab --checkpoint=checkpoints/gpt_9900.pt --out=checkpoints/gpt_small.pt
+
+which keeps rows [0, vocab_size) of wte and lm_head (vocab_size defaults to
+the tokenizer's) and optionally ties the two (--tie_weights=True, keeping the
+embedding). The output is a plain state dict for GPT.load_state_dict.
+"""
+
+import torch
+
+from gpt_mini.config import CONFIG
+from gpt_mini.utils import CfgNode as CN
+
+VOCAB_KEYS = ("transformer.wte.weight", "lm_head.weight")
+
+
+def tokenizer_vocab_size(tokenizer_path: str = CONFIG["tokenizer"]["model"]) -> int:
+    """the number of ids the trained tokenizer produces"""
+    from gpt_mini.bpe import load_tokenizer
+
+    return len(load_tokenizer(tokenizer_path))
+
+
+def model_state(checkpoint: dict) -> dict:
+    """the model weights of a state dict, or of a Trainer checkpoint / best.pt"""
+    return checkpoint["model"] if "model" in checkpoint else checkpoint
+
+
+def config_from_state(model_config, state: dict):
+    """set vocab_size and tie_weights of model_config to match the weights in state"""
+    wte, lm_head = state["transformer.wte.weight"], state["lm_head.weight"]
+    model_config.vocab_size = wte.size(0)
+    model_config.tie_weights = wte.data_ptr() == lm_head.data_ptr()
+    return model_config
+
+
+def default_model_config(model_type: str = None):
+    """a GPT config of CONFIG's shape, or of the preset model_type's (e.g. "gpt-nano")"""
+    from gpt_mini.model import GPT
+
+    model_config = GPT.get_default_config()
+    model_config.model_type = model_type
+    if model_type is None:
+        model_config.n_layer = CONFIG["model"]["n_layer"]
+        model_config.n_head = CONFIG["model"]["n_head"]
+        model_config.n_embd = CONFIG["model"]["n_embed"]
+    model_config.vocab_size = CONFIG["model"]["vocab_size"]
+    model_config.tie_weights = CONFIG["model"]["tie_weights"]
+    model_config.block_size = CONFIG["model"]["block_size"]
+    return model_config
+
+
+def load_checkpoint(path: str, model_type: str = None):
+    """
+    the GPT (in eval mode) with the weights of a state dict or Trainer
+    checkpoint at path, and its config. The shape is default_model_config's,
+    vocab_size and tie_weights are read from the weights.
+    """
+    from gpt_mini.model import GPT
+
+    state = model_state(torch.load(path, map_location="cpu", weights_only=False))
+    model_config = config_from_state(default_model_config(model_type), state)
+    model = GPT(model_config)
+    model.load_state_dict(state)
+    return model.eval(), model_config
+
+
+def remap_vocab(state: dict, vocab_size: int, tie_weights: bool = False) -> dict:
+    """
+    Return a copy of the model state dict with wte and lm_head cut down (or
+    grown, with new rows drawn like GPT's init) to vocab_size rows. Only
+    valid if the ids that get dropped are never produced by the tokenizer.
+    """
+    state = dict(state)
+    for key in VOCAB_KEYS:
+        weight = state[key]
+        if vocab_size <= weight.size(0):
+            state[key] = weight[:vocab_size].clone()
+        else:
+            extra = torch.empty(vocab_size - weight.size(0), weight.size(1), dtype=weight.dtype)
+            torch.nn.init.normal_(extra, mean=0.0, std=0.02)
+            state[key] = torch.cat([weight, extra])
+    if tie_weights:
+        state["lm_head.weight"] = state["transformer.wte.weight"]
+    return state
+
+
+def get_default_config():
+    C = CN()
+    C.checkpoint = None
+    C.out = None
+    # None: the size of the trained tokenizer
+    C.vocab_size = None
+    C.tokenizer = CONFIG["tokenizer"]["model"]
+    C.tie_weights = False
+    return C
+
+
+if __name__ == "__main__":
+    import sys
+
+    config = get_default_config()
+    config.merge_from_args(sys.argv[1:])
+    assert config.checkpoint is not None and config.out is not None, "need --checkpoint and --out"
+
+    vocab_size = config.vocab_size or tokenizer_vocab_size(config.tokenizer)
+    state = model_state(torch.load(config.checkpoint, map_location="cpu", weights_only=False))
+    before = state["transformer.wte.weight"].size(0)
+    torch.save(remap_vocab(state, vocab_size, config.tie_weights), config.out)
+    print(f"{config.checkpoint}: vocab {before} -> {vocab_size}"
+          f"{', tied' if config.tie_weights else ''}, wrote {config.out}")
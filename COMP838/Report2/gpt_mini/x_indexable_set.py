@@ -1,39 +1,102 @@
-import pickle
 import numpy as np
 
 class IndexableSet:
     def __init__(self, max_count: int):
-        self.dictionary = {}
+        self._dictionary = {}
         self.counter = 0
         self.max_count = max_count
+        # dense reverse mapping: _values[i] is the number with index i
+        # (over-allocated, only the first counter entries are in use)
+        self._values = np.zeros(16, dtype=np.int64)
+        # argsort of values (and the sorted values), for merging new
+        # arrays against the vocabulary
+        self._sorter = None
+        self._sorted = None
+
+    @property
+    def values(self) -> np.array:
+        return self._values[: self.counter]
+
+    @property
+    def dictionary(self) -> dict:
+        # only add() needs the dict, so the bulk path leaves it to catch up here
+        if len(self._dictionary) < self.counter:
+            start = len(self._dictionary)
+            self._dictionary.update(
+                zip(self._values[start : self.counter].tolist(), range(start, self.counter)))
+        return self._dictionary
+
+    def _check_room(self, n: int):
+        if self.max_count is not None and self.counter + n > self.max_count:
+            raise Exception("Maximum count of unique elements exceeded.")
+
+    def _extend(self, numbers: np.array):
+        n = len(numbers)
+        if self.counter + n > len(self._values):
+            grown = np.zeros(max(2 * len(self._values), self.counter + n), dtype=np.int64)
+            grown[: self.counter] = self.values
+            self._values = grown
+        self._values[self.counter : self.counter + n] = numbers
+        self.counter += n
+        self._sorter = None
 
     def add(self, number: int):
         if number not in self.dictionary:
-            if self.max_count is not None and self.counter >= self.max_count:
-                raise Exception("Maximum count of unique elements exceeded.")
-            self.dictionary[number] = self.counter
-            self.counter += 1
+            self._check_room(1)
+            self._extend(np.array([number], dtype=np.int64))
         return self.dictionary[number]
 
     def serialize(self, file_path):
+        # plain .npz, loading it never executes code (unlike pickle)
         with open(file_path, 'wb') as file:
-            pickle.dump((self.dictionary, self.counter), file)
+            np.savez(file, values=self.values)
 
     @classmethod
     def deserialize(cls, file_path, max_count: int):
-        with open(file_path, 'rb') as file:
-            dictionary, counter = pickle.load(file)
+        with np.load(file_path, allow_pickle=False) as data:
+            values = data["values"]
         instance = cls(max_count)
-        instance.dictionary = dictionary
-        instance.counter = counter
+        instance._extend(values.astype(np.int64))
         return instance
 
+    def _lookup(self, numbers: np.array) -> np.array:
+        """index of each number, -1 for numbers not in the set yet"""
+        if self.counter == 0:
+            return np.full(len(numbers), -1, dtype=np.int64)
+        if self._sorter is None:
+            self._sorter = np.argsort(self.values)
+            self._sorted = self.values[self._sorter]
+        pos = np.minimum(np.searchsorted(self._sorted, numbers), self.counter - 1)
+        return np.where(self._sorted[pos] == numbers, self._sorter[pos], -1)
+
     def index_array(self, ary: np.array) -> np.array:
-        return np.vectorize(lambda x: self.add(x))(ary)
+        """
+        Index a whole array in one go. Numbers not seen before get new
+        indices in order of first appearance, same as calling add() on
+        each element in turn.
+        """
+        ary = np.asarray(ary)
+        # merge against the existing vocabulary first, only the numbers we
+        # have not seen yet need to go through np.unique
+        ids = self._lookup(ary.ravel().astype(np.int64))
+        new = ids < 0
+        if new.any():
+            uniq, first, inverse = np.unique(
+                ary.ravel()[new], return_index=True, return_inverse=True)
+            order = np.argsort(first)
+            self._check_room(len(order))
+            new_ids = np.empty(len(order), dtype=np.int64)
+            new_ids[order] = np.arange(self.counter, self.counter + len(order))
+            ids[new] = new_ids[inverse]
+            self._extend(uniq[order].astype(np.int64))
+        return ids.reshape(ary.shape)
 
     def reverse_index_array(self, ary: np.array) -> np.array:
-        reverse_dict = {v: k for k, v in self.dictionary.items()}
-        return np.vectorize(lambda x: reverse_dict.get(x, None))(ary)
+        # raises IndexError for indices that were never handed out
+        ary = np.asarray(ary)
+        if ary.size and (ary.min() < 0 or ary.max() >= self.counter):
+            raise IndexError(f"index out of range for set of {self.counter} elements")
+        return self.values[ary]
 
 
 if __name__ == "__main__":
@@ -45,13 +108,13 @@ if __name__ == "__main__":
     assert indexable_set.add(4) == 2
 
     # Serialize the object
-    indexable_set.serialize('indexable_set.pkl')
+    indexable_set.serialize('indexable_set.npz')
 
     # Deserialize the object
-    deserialized_set = IndexableSet.deserialize('indexable_set.pkl', max_count=3)
+    deserialized_set = IndexableSet.deserialize('indexable_set.npz', max_count=3)
     print(deserialized_set.add(3))  # Output: 1
 
     try:
         print(indexable_set.add(5))  # This will raise an exception
     except Exception as e:
-        print(e)  # Output: Maximum count of unique elements exceeded.
\ No newline at end of file
+        print(e)  # Output: Maximum count of unique elements exceeded.